@@ -1,71 +1,197 @@
-import ast
+import os
+import asyncio
+import contextvars
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from langchain_openai import AzureOpenAIEmbeddings
-from langchain_chroma import Chroma
-from langchain_openai import AzureChatOpenAI
-from langchain_core.tools import tool 
-from langchain_core.messages import BaseMessage, ToolMessage, SystemMessage
+from langchain_core.tools import StructuredTool
+from langchain_core.runnables import RunnableLambda
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage, SystemMessage
 
 from typing import Annotated, Sequence, TypedDict
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 
-from utils import OPENAI_API_VERSION, OPENAI_API_KEY, OPENAI_API_ENDPOINT
-from embedding import PERSIST_DIRECTORY, EMBEDDING_MODEL
+from config import OPENAI_API_VERSION, OPENAI_API_KEY, OPENAI_API_ENDPOINT
+from config import PERSIST_DIRECTORY, HIERARCHY_TREE_PATH, INDEX_MANIFEST_PATH, LEXICAL_INDEX_PATH, LIBRARY_MANIFEST_PATH
+from embedding_backends import build_embedding, embedding_model_id, check_index_model
 from hierarchical_retriever import SingleRetriever, HierarchicalRetriever
+from vector_index import NumpyVectorStore, QuantizedVectorStore, QUANTIZATION_CONFIG, full_vectors_path
+from embedding_cache import QueryEmbeddingCache
+from hierarchy_tree import HierarchyTree
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+from library import Library
+from prefetch import Prefetcher, PREFETCH_CONFIG
+from context_manager import manage_context, current_turn_start
+from answer_cache import SemanticAnswerCache
+import telemetry
 
 
 LLM_MODEL = 'gpt-4.1'
 
 levels = [1,2,3,4,5]
 TOP_K = [10, 10, 7, 7, 5]
+MAX_PARALLEL_TOOL_CALLS = 6
+ANSWER_CACHE_PATH = 'cache/answer_cache.json'
+WARM_UP_QUERY = 'warm up'
+
+# 'chroma' queries the persisted stores directly, 'numpy' loads every level into RAM once at startup,
+# 'quantized' keeps only compressed vectors in RAM and re-scores candidates from memory-mapped full vectors
+RETRIEVAL_BACKEND = os.environ.get('RETRIEVAL_BACKEND', 'chroma')
+
+QUERY_CACHE_CONFIG = {
+    'max_size' : 1024,
+    'ttl_seconds' : 3600
+}
+
+# Clients, stores and the graph are built on first use and then shared by the whole process (and every Streamlit rerun)
+@lru_cache(maxsize=None)
+def get_embedding():
+    check_index_model(INDEX_MANIFEST_PATH, embedding_model_id())
+    return QueryEmbeddingCache(build_embedding(), **QUERY_CACHE_CONFIG)
+
+@lru_cache(maxsize=None)
+def get_llm():
+    from langchain_openai import AzureChatOpenAI
+    llm = AzureChatOpenAI(
+        api_version=OPENAI_API_VERSION,
+        azure_endpoint=OPENAI_API_ENDPOINT,
+        api_key=OPENAI_API_KEY,
+        azure_deployment=LLM_MODEL,
+        temperature = 0
+    )
+    return llm.bind_tools(tools)
+
+@lru_cache(maxsize=None)
+def get_vector_stores():
+    from langchain_chroma import Chroma
+
+    if RETRIEVAL_BACKEND not in ('chroma', 'numpy', 'quantized'):
+        raise ValueError(f"Unknown RETRIEVAL_BACKEND '{RETRIEVAL_BACKEND}', expected 'chroma', 'numpy' or 'quantized'.")
+    embedding = get_embedding()
+    vector_stores = [
+        Chroma(embedding_function=embedding, persist_directory=f"{PERSIST_DIRECTORY}/chunk_level_{level}")
+        for level in levels
+    ]
+    if RETRIEVAL_BACKEND == 'numpy':
+        vector_stores = [NumpyVectorStore.from_chroma(store, embedding) for store in vector_stores]
+    elif RETRIEVAL_BACKEND == 'quantized':
+        vector_stores = [
+            QuantizedVectorStore.from_chroma(store, embedding, full_vectors_path=full_vectors_path(PERSIST_DIRECTORY, level), **QUANTIZATION_CONFIG)
+            for store, level in zip(vector_stores, levels)
+        ]
+    return vector_stores
+
+def store_metadatas(store):
+    if isinstance(store, NumpyVectorStore):
+        return [doc.metadata for doc in store.documents]
+    return store.get(include=['metadatas'])['metadatas']
+
+@lru_cache(maxsize=None)
+def get_hierarchy_tree():
+    # Indexes built before the tree file existed fall back to reading group_index from the stores, once
+    if os.path.exists(HIERARCHY_TREE_PATH):
+        return HierarchyTree.load(HIERARCHY_TREE_PATH)
+    return HierarchyTree.from_metadatas({
+        f"level_{level}": store_metadatas(store) for store, level in zip(get_vector_stores(), levels)
+    })
+
+@lru_cache(maxsize=None)
+def get_library():
+    # None for a single-book index, whose tree and keyword index are global
+    if not os.path.exists(LIBRARY_MANIFEST_PATH):
+        return None
+    return Library(LIBRARY_MANIFEST_PATH)
+
+@lru_cache(maxsize=None)
+def get_retriever():
+    retrievers = [
+        SingleRetriever(store, top_k=top_k, level_name=f"level_{level}")
+        for store, top_k, level in zip(get_vector_stores(), TOP_K, levels)
+    ]
+    library = get_library()
+    tree = get_hierarchy_tree() if library is None else None
+    # The in-memory backends already search locally, prefetching only saves round-trips to Chroma
+    prefetcher = None
+    if RETRIEVAL_BACKEND == 'chroma' and PREFETCH_CONFIG['enabled']:
+        prefetcher = Prefetcher({level: store for level, store in zip(levels, get_vector_stores())})
+    return HierarchicalRetriever(retrievers, embedding=get_embedding(), tree=tree, library=library, prefetcher=prefetcher)
+
+@lru_cache(maxsize=None)
+def get_lexical_index():
+    # Indexes built before the keyword index existed cite with the dense descent only
+    if not os.path.exists(LEXICAL_INDEX_PATH):
+        return None
+    return LexicalIndex.load(LEXICAL_INDEX_PATH)
+
+@lru_cache(maxsize=None)
+def get_answer_cache():
+    return SemanticAnswerCache(get_embedding(), ANSWER_CACHE_PATH, INDEX_MANIFEST_PATH)
+
+def warm_up():
+    '''
+    Opens every store, loads the tree and embeds a probe query so the first real question pays no setup cost.
+    '''
+    with telemetry.span('warm_up'):
+        retriever = get_retriever()
+        query_vector = retriever.embed_query(WARM_UP_QUERY)
+        for level in levels:
+            retriever.get_retriever(f"level_{level}").retrieve_documents(WARM_UP_QUERY, query_vector=query_vector)
+        get_llm()
+        get_lexical_index()
+        get_answer_cache()
+
+def format_documents(docs, level, with_page=False, scores=None):
+    if not docs:
+        return "There is no relevant information in the document"
 
-embedding = AzureOpenAIEmbeddings(model = EMBEDDING_MODEL, openai_api_version = OPENAI_API_VERSION, azure_endpoint = OPENAI_API_ENDPOINT, api_key = OPENAI_API_KEY)
-
-llm = AzureChatOpenAI(
-    api_version=OPENAI_API_VERSION,
-    azure_endpoint=OPENAI_API_ENDPOINT,
-    api_key=OPENAI_API_KEY,
-    azure_deployment='gpt-4.1',
-    temperature = 0
-)
-
-vector_stores = [
-    Chroma(embedding_function=embedding, persist_directory=f"{PERSIST_DIRECTORY}/chunk_level_{level}")
-    for level in levels
-]
-
-retrievers = [
-    SingleRetriever(store, top_k=top_k, level_name=f"level_{level}")
-    for store, top_k, level in zip(vector_stores, TOP_K, levels)
-]
+    # The [L<level> #<chunk_index>] tag (plus the book id in a library) lets the context manager spot chunks that were already shown this turn
+    results = []
+    for i, doc in enumerate(docs):
+        book = f" {doc.metadata['book_id']}" if doc.metadata.get('book_id') else ""
+        header = f"Document {i+1} [L{level} #{doc.metadata.get('chunk_index')}{book}]"
+        if with_page:
+            header += f" (Page {doc.metadata.get('page')})"
+        if scores is not None and scores[i] is not None:
+            header += f" score={scores[i]:.3f}"
+        results.append(f"{header}:\n{doc.page_content}")
 
-hirerachical_retriever = HierarchicalRetriever(retrievers)
+    return "\n\n".join(results)
 
-@tool
-def retrieve_by_level(query: str, level : int) -> str:
+def format_descent(hits, trace, level, with_page=False, keyword_matches=None):
+    steps = []
+    for step in trace:
+        if 'books' in step:
+            steps.append("books " + ", ".join(f"{book_id} ({score:.3f})" for book_id, score in step['books']))
+            continue
+        best = f"{step['best']:.3f}" if step['best'] is not None else "-"
+        note = ", one branch dominates" if step['dominant'] else ""
+        steps.append(f"L{step['level']} best={best} kept {step['kept']}/{step['hits']}{note}")
+
+    path = ' -> '.join(steps)
+    if keyword_matches is not None:
+        path += f" + keyword index: {keyword_matches} matching chunks"
+    documents = format_documents([doc for doc, _ in hits], level, with_page=with_page, scores=[score for _, score in hits])
+    return f"Search path: {path}\n\n{documents}"
+
+def retrieve_by_level(query: str, level : int, indices : list[int] | None = None, book : str | None = None) -> str:
     ''' 
     This tool searchs and returns the information from the PDF file using similarity strategy
     Args:
         query (str) : The question user ask
         level (int) : A single number at the current number you want to search
+        indices (list[int], optional) : Only search these chunk numbers (the #N of the [L<level> #N] tags) at this level
+        book (str, optional) : When several books are indexed, only search this book (the book id ending the tags)
     Return:
         str : The retrieval result
     '''
+    docs = get_retriever().retrieve_by_level(query, f"level_{level}", indices=indices, book=book)
+    return format_documents(docs, level)
 
-    level_name = f"level_{level}"
-    docs = hirerachical_retriever.retrieve_by_level(query, level_name)
-
-    if not docs:
-        return "There is no relevant information in the document"
-    
-    results = []
-    for i, doc in enumerate(docs):
-        results.append(f"Document {i+1}:\n{doc.page_content}")
-
-    return "\n\n".join(results)
+async def aretrieve_by_level(query: str, level : int, indices : list[int] | None = None, book : str | None = None) -> str:
+    docs = await get_retriever().aretrieve_by_level(query, f"level_{level}", indices=indices, book=book)
+    return format_documents(docs, level)
 
-@tool
 def retrieve_across_level(query : str, high_level : int, low_level : int) -> str:
     '''  
     This tool searchs and returns the information from the PDF file using similarity strategy
@@ -79,34 +205,18 @@ def retrieve_across_level(query : str, high_level : int, low_level : int) -> str
     '''
     if low_level >= high_level:
         return "High_level should be a higher value"
-    
-    relevant_indices = []
-    for level in range(high_level, low_level, -1):
-
-        current_level = f"level_{level}"
-        # print(f"Searching at {current_level} with relevant indices {relevant_indices}")
-        
-        docs = hirerachical_retriever.retrieve_by_level(query = query, level=current_level, indices=relevant_indices)
-
-        if docs:
-            relevant_indices = []
-            for doc in docs:
-                group_index = doc.metadata['group_index']
-                group_index = ast.literal_eval(group_index)
-                relevant_indices = relevant_indices + group_index
-
-    final_level = f"level_{low_level}"
-    # print(f"Searching at {final_level} with relevant indices {relevant_indices}\n")
-
-    final_results = []
-    final_docs = hirerachical_retriever.retrieve_by_level(query, final_level, relevant_indices)
-    for i, doc in enumerate(final_docs):
-        final_results.append(f"Document {i+1}:\n{doc.page_content}")
-
-    return "\n\n".join(final_results)
-
-@tool
-def cite_from_documents(keyword : str, high_level : int) -> list:
+
+    hits, trace = get_retriever().descend(query, high_level, low_level)
+    return format_descent(hits, trace, low_level)
+
+async def aretrieve_across_level(query : str, high_level : int, low_level : int) -> str:
+    if low_level >= high_level:
+        return "High_level should be a higher value"
+
+    hits, trace = await get_retriever().adescend(query, high_level, low_level)
+    return format_descent(hits, trace, low_level)
+
+def cite_from_documents(keyword : str, high_level : int) -> str:
     '''  
     This tool searches and return the raw text and page from the PDF file using similarity strategy
     Relevant documents indices are searched from high_level (summarization) straight to level 1
@@ -114,43 +224,96 @@ def cite_from_documents(keyword : str, high_level : int) -> list:
         keyword (str) : Some keyword of the result from high_level that you found
         high_level : The level where searching start (high level)
     Return :
-        list : List of page : raw_text 
+        str : List of page : raw_text 
     '''
     low_level = 1
     if low_level >= high_level:
         return "High_level should be a higher value"
-    
-    relevant_indices = []
-    for level in range(high_level, low_level, -1):
 
-        current_level = f"level_{level}"
-        # print(f"Searching at {current_level} with relevant indices {relevant_indices}")
-        
-        docs = hirerachical_retriever.retrieve_by_level(query = keyword, level=current_level, indices=relevant_indices)
-
-        if docs:
-            relevant_indices = []
-            for doc in docs:
-                group_index = doc.metadata['group_index']
-                group_index = ast.literal_eval(group_index)
-                relevant_indices = relevant_indices + group_index
-
-    final_level = f"level_{low_level}"
-    # print(f"Searching at {final_level} with relevant indices {relevant_indices}\n")
-
-    final_docs = hirerachical_retriever.retrieve_by_level(keyword, final_level, relevant_indices)
-    final_results = []
-    for i, doc in enumerate(final_docs):
-        final_results.append(f"Page {doc.metadata['page']}:\n{doc.page_content}")
+    # A library routes the keyword to books before any lookup, single-book exact quotes need no embedding
+    retriever = get_retriever()
+    query_vector = retriever.embed_query(keyword) if retriever.library is not None else None
+    citations = exact_citations(keyword, query_vector)
+    if citations is not None:
+        return citations
+    if query_vector is None:
+        query_vector = retriever.embed_query(keyword)
+    hits, trace = retriever.descend(keyword, high_level, low_level, query_vector=query_vector)
+    return format_citations(keyword, hits, trace, query_vector)
+
+async def acite_from_documents(keyword : str, high_level : int) -> str:
+    low_level = 1
+    if low_level >= high_level:
+        return "High_level should be a higher value"
 
-    return final_docs
+    retriever = get_retriever()
+    query_vector = await retriever.aembed_query(keyword) if retriever.library is not None else None
+    citations = exact_citations(keyword, query_vector)
+    if citations is not None:
+        return citations
+    if query_vector is None:
+        query_vector = await retriever.aembed_query(keyword)
+    hits, trace = await retriever.adescend(keyword, high_level, low_level, query_vector=query_vector)
+    return format_citations(keyword, hits, trace, query_vector)
+
+def lexical_indexes(query_vector=None):
+    # [(book_id, keyword index)]: the single-book index, or those of the books the query is routed to
+    library = get_library()
+    if library is None:
+        index = get_lexical_index()
+        return [] if index is None else [(None, index)]
+    indexes = [(book_id, library.lexical_index(book_id)) for book_id, _ in get_retriever().route(query_vector)]
+    return [(book_id, index) for book_id, index in indexes if index is not None]
+
+def lexical_document(book_id, index, row):
+    doc = index.document(row)
+    if book_id is not None:
+        doc.metadata['book_id'] = book_id
+    return doc
+
+def exact_citations(keyword, query_vector=None):
+    # Quotes of two words or more found word for word in level 1 are answered from the keyword index alone, best BM25 first.
+    # A single word would match any chunk using it, so it goes through the ranked search
+    if len(tokenize(keyword)) < 2:
+        return None
+    with telemetry.span('phrase_search'):
+        matches = []
+        for book_id, index in lexical_indexes(query_vector):
+            rows = index.phrase_search(keyword)
+            if rows:
+                scores = index.bm25_scores(keyword)
+                matches.extend((float(scores[row]), book_id, index, row) for row in rows)
+    if not matches:
+        return None
+    matches.sort(key=lambda match: -match[0])
+    docs = [lexical_document(book_id, index, row) for _, book_id, index, row in matches[:TOP_K[0]]]
+    scores = [score for score, _, _, _ in matches[:TOP_K[0]]]
+    return f"Exact matches: {len(matches)} chunks contain \"{keyword}\" word for word, best BM25 score first.\n\n" + format_documents(docs, 1, with_page=True, scores=scores)
+
+def format_citations(keyword, hits, trace, query_vector=None):
+    # Hybrid mode: the dense descent ranking and the BM25 ranking are merged with reciprocal rank fusion
+    indexes = lexical_indexes(query_vector)
+    if not indexes:
+        return format_descent(hits, trace, 1, with_page=True)
+
+    lexical = sorted(
+        ((score, book_id, index, row) for book_id, index in indexes for row, score in index.bm25(keyword, TOP_K[0])),
+        key=lambda match: -match[0]
+    )[:TOP_K[0]]
+    dense_hits = {(doc.metadata.get('book_id'), doc.metadata['chunk_index']): (doc, score) for doc, score in hits}
+    lexical_docs = {(book_id, int(index.chunk_indices[row])): (book_id, index, row) for _, book_id, index, row in lexical}
+    fused = reciprocal_rank_fusion([list(dense_hits), list(lexical_docs)])[:TOP_K[0]]
+    hits = [dense_hits.get(key) or (lexical_document(*lexical_docs[key]), None) for key in fused]
+    return format_descent(hits, trace, 1, with_page=True, keyword_matches=len(lexical))
+
+retrieve_by_level = StructuredTool.from_function(func=retrieve_by_level, coroutine=aretrieve_by_level)
+retrieve_across_level = StructuredTool.from_function(func=retrieve_across_level, coroutine=aretrieve_across_level)
+cite_from_documents = StructuredTool.from_function(func=cite_from_documents, coroutine=acite_from_documents)
 
 tools = [retrieve_by_level, retrieve_across_level, cite_from_documents]
 tools_dict = {tool.name : tool for tool in tools}
 
 
-llm = llm.bind_tools(tools)
-
 system_prompts = ''
 try:
     with open('configs/prompts.txt', 'r', encoding='utf-8') as f:
@@ -170,31 +333,96 @@ def should_continue(state: AgentState):
     result = state['messages'][-1]
     return hasattr(result, 'tool_calls') and len(result.tool_calls) > 0
 
+def record_llm_usage(messages, result):
+    if not telemetry.enabled:
+        return
+    usage = getattr(result, 'usage_metadata', None) or {}
+    telemetry.record('llm_input_tokens', usage.get('input_tokens', 0))
+    telemetry.record('llm_output_tokens', usage.get('output_tokens', 0))
+    if result.tool_calls:
+        return
+
+    # Final answer: one event per user turn with the number of LLM calls (graph iterations) and the tokens they used
+    turn = [message for message in messages[current_turn_start(messages):] if isinstance(message, AIMessage)] + [result]
+    turn_usage = [getattr(message, 'usage_metadata', None) or {} for message in turn]
+    telemetry.record('turns', 1,
+        iterations=len(turn),
+        input_tokens=sum(usage.get('input_tokens', 0) for usage in turn_usage),
+        output_tokens=sum(usage.get('output_tokens', 0) for usage in turn_usage)
+    )
+    telemetry.record('graph_iterations', len(turn))
+
 def call_llm(state: AgentState) -> AgentState:
     messages = [SystemMessage(content=system_prompts)] + list(state['messages'])
-    result = llm.invoke(messages)
+    with telemetry.span('call_llm'):
+        result = get_llm().invoke(messages)
+    record_llm_usage(state['messages'], result)
+    return {'messages': [result]}
+
+async def acall_llm(state: AgentState) -> AgentState:
+    messages = [SystemMessage(content=system_prompts)] + list(state['messages'])
+    with telemetry.span('call_llm'):
+        result = await get_llm().ainvoke(messages)
+    record_llm_usage(state['messages'], result)
     return {'messages': [result]}
 
+def context_manager(state: AgentState) -> AgentState:
+    with telemetry.span('context_manager'):
+        return {'messages': manage_context(state['messages'])}
+
+def run_tool(t):
+    print(f"Calling Tool: {t['name']} with args: {t['args']}")
+
+    if t['name'] not in tools_dict:
+        return ToolMessage(tool_call_id=t['id'], name=t['name'], content=f"Tool '{t['name']}' not found.", status='error')
+    try:
+        with telemetry.span('tool', labels={'tool': t['name']}, args=t['args']):
+            content = tools_dict[t['name']].invoke(t['args'])
+    except Exception as e:
+        return ToolMessage(tool_call_id=t['id'], name=t['name'], content=f"Tool '{t['name']}' failed: {e}", status='error')
+    return ToolMessage(tool_call_id=t['id'], name=t['name'], content=str(content))
+
 def tool_call(state: AgentState) -> AgentState:
     tool_calls = state['messages'][-1].tool_calls
-    results = []
 
-    for t in tool_calls:
+    # Independent calls from one LLM turn run concurrently, results stay in tool_call order.
+    # Each call runs in a copy of this context so the chat session (prefetch cache) follows it into the worker thread
+    with telemetry.span('tool_call', calls=len(tool_calls)):
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_TOOL_CALLS, len(tool_calls))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, run_tool, t) for t in tool_calls]
+            results = [future.result() for future in futures]
+
+    state['messages'] = state['messages'] + results
+    return state
+
+async def arun_tool(t, semaphore):
+    async with semaphore:
         print(f"Calling Tool: {t['name']} with args: {t['args']}")
 
         if t['name'] not in tools_dict:
-            content = f"Tool '{t['name']}' not found."
-        else:
-            content = tools_dict[t['name']].invoke(t['args'])
-        results.append(ToolMessage(tool_call_id=t['id'], name=t['name'], content=str(content)))
+            return ToolMessage(tool_call_id=t['id'], name=t['name'], content=f"Tool '{t['name']}' not found.", status='error')
+        try:
+            with telemetry.span('tool', labels={'tool': t['name']}, args=t['args']):
+                content = await tools_dict[t['name']].ainvoke(t['args'])
+        except Exception as e:
+            return ToolMessage(tool_call_id=t['id'], name=t['name'], content=f"Tool '{t['name']}' failed: {e}", status='error')
+        return ToolMessage(tool_call_id=t['id'], name=t['name'], content=str(content))
+
+async def atool_call(state: AgentState) -> AgentState:
+    tool_calls = state['messages'][-1].tool_calls
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_TOOL_CALLS)
+    with telemetry.span('tool_call', calls=len(tool_calls)):
+        results = await asyncio.gather(*(arun_tool(t, semaphore) for t in tool_calls))
 
-    state['messages'] = state['messages'] + results
+    state['messages'] = state['messages'] + list(results)
     return state
 
 def create_app():
     G = StateGraph(AgentState)
-    G.add_node('llm', call_llm)
-    G.add_node('retriever_agent', tool_call)
+    # Each node has a sync and an async body: app.invoke runs the former, app.ainvoke / app.astream the latter
+    G.add_node('llm', RunnableLambda(call_llm, afunc=acall_llm))
+    G.add_node('retriever_agent', RunnableLambda(tool_call, afunc=atool_call))
+    G.add_node('context_manager', context_manager)
 
     G.add_conditional_edges(
         source='llm',
@@ -205,7 +433,8 @@ def create_app():
         }
     )
 
-    G.add_edge('retriever_agent', 'llm')
-    G.set_entry_point('llm')
+    G.add_edge('retriever_agent', 'context_manager')
+    G.add_edge('context_manager', 'llm')
+    G.set_entry_point('context_manager')
     app = G.compile()
     return app
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from embedding_cache import normalize_text
+
+ANSWER_CACHE_CONFIG = {
+    'similarity_threshold' : 0.95,
+    'max_size' : 512,
+    'ttl_seconds' : 7 * 24 * 3600,
+    'min_question_words' : 3
+}
+
+def is_cacheable(question, earlier_messages=()):
+    # Only the opening question of a conversation: later ones ("what does she think about him?") may lean on earlier turns
+    # whatever their length. Very short questions ("why?") go through the agent too
+    return not earlier_messages and len(question.split()) >= ANSWER_CACHE_CONFIG['min_question_words']
+
+def index_fingerprint(manifest_path):
+    # embedding.py rewrites the manifest with a new build id on every (re)index, indexes built before it existed share one fingerprint
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class SemanticAnswerCache:
+    '''
+    Answers keyed by the embedding of the question: a new question reuses a stored answer when its cosine similarity
+    to a cached question is above the threshold. Exact repeats are matched on the normalized text before any embedding call.
+    Entries are bounded by size (least recently used first) and TTL, persisted to disk, and dropped when the index changes.
+    '''
+    def __init__(self, embedding, path, manifest_path, similarity_threshold=None, max_size=None, ttl_seconds=None):
+        self.embedding = embedding
+        self.path = path
+        self.vectors_path = os.path.splitext(path)[0] + '.npy'
+        self.manifest_path = manifest_path
+        self.similarity_threshold = ANSWER_CACHE_CONFIG['similarity_threshold'] if similarity_threshold is None else similarity_threshold
+        self.max_size = ANSWER_CACHE_CONFIG['max_size'] if max_size is None else max_size
+        self.ttl_seconds = ANSWER_CACHE_CONFIG['ttl_seconds'] if ttl_seconds is None else ttl_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fingerprint = index_fingerprint(manifest_path)
+        self.entries = []
+        self.vectors = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path) or not os.path.exists(self.vectors_path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            vectors = np.load(self.vectors_path)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable answer cache at {self.path}: {e}")
+            return
+        if data.get('fingerprint') != self.fingerprint or len(data.get('entries', [])) != len(vectors):
+            print("Index changed since the answer cache was written, starting with an empty cache.")
+            return
+        if data['entries']:
+            self.entries = data['entries']
+            self.vectors = vectors.astype(np.float32)
+        self._evict(time.time())
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': self.fingerprint, 'entries': self.entries}, f, ensure_ascii=False)
+            vectors = self.vectors if self.vectors is not None else np.zeros((0, 0), dtype=np.float32)
+            with open(self.vectors_path + '.tmp', 'wb') as f:
+                np.save(f, vectors)
+            os.replace(self.path + '.tmp', self.path)
+            os.replace(self.vectors_path + '.tmp', self.vectors_path)
+
+    def _check_index(self):
+        fingerprint = index_fingerprint(self.manifest_path)
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.entries = []
+            self.vectors = None
+
+    def _evict(self, now):
+        keep = [i for i, entry in enumerate(self.entries) if now - entry['created'] < self.ttl_seconds]
+        if len(keep) > self.max_size:
+            keep = sorted(keep, key=lambda i: self.entries[i]['last_used'])[-self.max_size:]
+            keep.sort()
+        if len(keep) != len(self.entries):
+            self.entries = [self.entries[i] for i in keep]
+            self.vectors = self.vectors[keep] if keep else None
+
+    def _embed(self, question):
+        vector = np.asarray(self.embedding.embed_query(question), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def lookup(self, question):
+        key = normalize_text(question).lower()
+        now = time.time()
+        with self.lock:
+            self._check_index()
+            self._evict(now)
+            for entry in self.entries:
+                if entry['key'] == key:
+                    entry['last_used'] = now
+                    self.hits += 1
+                    return entry['answer']
+            if not self.entries:
+                self.misses += 1
+                return None
+
+        vector = self._embed(question)
+        with self.lock:
+            if self.vectors is None or not self.entries:
+                self.misses += 1
+                return None
+            scores = self.vectors @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self.entries[best]['last_used'] = now
+            self.hits += 1
+            return self.entries[best]['answer']
+
+    def store(self, question, answer):
+        vector = self._embed(question)
+        now = time.time()
+        with self.lock:
+            self.entries.append({
+                'key': normalize_text(question).lower(),
+                'question': question,
+                'answer': answer,
+                'created': now,
+                'last_used': now
+            })
+            self.vectors = vector[None, :] if self.vectors is None else np.vstack([self.vectors, vector])
+            self._evict(now)
+        self.save()
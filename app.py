@@ -1,37 +1,57 @@
-from agent import create_app
-from langchain_core.messages import HumanMessage
-
 import streamlit as st
 import asyncio
+import uuid
 
-from langchain_core.messages import HumanMessage
-from agent import create_app
+from langchain_core.messages import HumanMessage, AIMessage
+from agent import create_app, get_answer_cache, warm_up
+from answer_cache import is_cacheable
+from prefetch import current_session
 
-app = create_app()
+@st.cache_resource(show_spinner="Opening the library...")
+def load_app():
+    # Built once per server process, Streamlit reruns the script on every interaction but reuses this
+    app = create_app()
+    warm_up()
+    return app
 
 ai_avatar = "imgs/AI_Avatar.png"
 
 #Deploy app on streamlit
-@st.cache_resource
-def run_async_task(async_func, *args):
-    loop = None
-    try:
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(async_func(*args))
-    except:
-        if loop is not None:
-            loop.close()
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(async_func(*args))
-    finally:
-        if loop is not None:
-            loop.close()
+async def stream_answer(app, chat_history, status, placeholder):
+    answer = ""
+    final_state = None
+    async for event in app.astream_events({"messages": chat_history}, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_start":
+            answer = ""
+        elif kind == "on_chat_model_stream":
+            token = event["data"]["chunk"].content
+            if isinstance(token, str) and token:
+                answer += token
+                placeholder.markdown(answer + "▌")
+        elif kind == "on_tool_start":
+            status.write(f"Searching with `{event['name']}`: {event['data'].get('input')}")
+        elif kind == "on_tool_end":
+            status.write(f"`{event['name']}` finished")
+        elif kind == "on_chain_end" and not event["parent_ids"]:
+            final_state = event["data"]["output"]
+
+    assistant_msg = final_state["messages"][-1]
+    placeholder.markdown(assistant_msg.content)
+    return assistant_msg
 
 async def main():
     st.title("📚🌸 Lina Novel ")
+    app = load_app()
+    answer_cache = get_answer_cache()
+    stream_responses = st.sidebar.toggle("Stream responses", value=True)
 
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
+    # Keys this browser session's prefetch cache, every search below runs in this context
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    current_session.set(st.session_state.session_id)
 
     for msg in st.session_state.chat_history:
         if isinstance(msg, HumanMessage):
@@ -45,18 +65,30 @@ async def main():
 
     if user_input:
         user_msg = HumanMessage(content=user_input)
+        cacheable = is_cacheable(user_input, st.session_state.chat_history)
         st.session_state.chat_history.append(user_msg)
 
         with st.chat_message("user"):
             st.markdown(user_input)
 
         try:
-            result = app.invoke({"messages": st.session_state.chat_history})
-            assistant_msg = result["messages"][-1]
-            st.session_state.chat_history.append(assistant_msg)
-
             with st.chat_message("assistant", avatar=ai_avatar):
-                st.markdown(assistant_msg.content)
+                cached_answer = answer_cache.lookup(user_input) if cacheable else None
+                if cached_answer is not None:
+                    assistant_msg = AIMessage(content=cached_answer)
+                    st.markdown(cached_answer)
+                elif stream_responses:
+                    status = st.status("Reading the book...", expanded=False)
+                    placeholder = st.empty()
+                    assistant_msg = await stream_answer(app, st.session_state.chat_history, status, placeholder)
+                    status.update(label="Done reading", state="complete")
+                else:
+                    result = await app.ainvoke({"messages": st.session_state.chat_history})
+                    assistant_msg = result["messages"][-1]
+                    st.markdown(assistant_msg.content)
+                if cached_answer is None and cacheable:
+                    answer_cache.store(user_input, assistant_msg.content)
+            st.session_state.chat_history.append(assistant_msg)
 
         except Exception as e:
             error_message = str(e)
@@ -71,6 +103,8 @@ async def main():
 
 def run_agent():
     print("\n=== NOVEL READING IMOUTO ===")
+    app = create_app()
+    answer_cache = get_answer_cache()
 
     while True:
         user_input = input("\nUser: ")
@@ -79,10 +113,14 @@ def run_agent():
         print("\nOni-chan: ", user_input)
         messages = [HumanMessage(content=user_input)]
 
-        result = app.invoke({"messages" : messages}, {"recursion_limit": 100})
+        answer = answer_cache.lookup(user_input) if is_cacheable(user_input) else None
+        if answer is None:
+            result = app.invoke({"messages" : messages}, {"recursion_limit": 100})
+            answer = result['messages'][-1].content
+            if is_cacheable(user_input):
+                answer_cache.store(user_input, answer)
 
-        print("\nImouto: ",result['messages'][-1].content)
+        print("\nImouto: ", answer)
 
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    loop.run_until_complete(main())
+    asyncio.run(main())
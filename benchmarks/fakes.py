@@ -0,0 +1,133 @@
+import re
+import json
+import time
+import hashlib
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Deterministic local stand-ins for the Azure clients, with configurable artificial latency so the benchmarks
+# measure our own overhead plus a predictable amount of simulated network time.
+
+def approximate_tokens(text):
+    # tiktoken needs to download its encodings, the benchmarks stay offline with the usual ~4 characters per token estimate
+    return max(1, len(text) // 4)
+
+
+class HashingEmbeddings(Embeddings):
+    '''
+    Feature-hashed bag of words: texts sharing words get similar unit vectors, so descent behaves like it does on real data.
+    '''
+    def __init__(self, size=256, latency_ms=0.0, batch_latency_ms=None):
+        self.size = size
+        self.latency_ms = latency_ms
+        self.batch_latency_ms = latency_ms if batch_latency_ms is None else batch_latency_ms
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in re.findall(r"[a-z']+", text.lower()):
+            digest = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[digest % self.size] += 1.0 if (digest >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0] = 1.0
+            norm = 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        time.sleep(self.batch_latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        self.texts_embedded += 1
+        time.sleep(self.latency_ms / 1000)
+        return self._embed(text)
+
+
+class FakeSummarizer:
+    '''
+    Mimics load_summarize_chain(...).invoke(group): keeps the first sentence of every document in the group.
+    '''
+    def __init__(self, latency_ms=0.0, failure_rate=0.0):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    def invoke(self, group):
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        # The same groups are refused on every run, like a content filter would
+        digest = hashlib.blake2b(group[0].page_content.encode('utf-8'), digest_size=4).digest()
+        if int.from_bytes(digest, 'little') / 2**32 < self.failure_rate:
+            raise ValueError("The response was filtered due to the prompt triggering Azure OpenAI's content management policy.")
+        sentences = [re.split(r'(?<=[.!?])\s', doc.page_content.strip(), maxsplit=1)[0] for doc in group]
+        return {'output_text': ' '.join(sentences)}
+
+
+class ScriptedToolChatModel(BaseChatModel):
+    '''
+    Plays one fixed agent turn: retrieve_by_level on the question, then cite_from_documents, then a final answer.
+    The next step is derived from the messages, so concurrent turns do not interfere.
+    '''
+    latency_ms: float = 0.0
+    answer_words: int = 60
+
+    @property
+    def _llm_type(self):
+        return 'scripted-tool-chat'
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _respond(self, messages):
+        message = self._script(messages)
+        input_tokens = sum(approximate_tokens(str(m.content)) for m in messages)
+        output_tokens = approximate_tokens(message.content or json.dumps([call['args'] for call in message.tool_calls]))
+        message.usage_metadata = {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens}
+        return message
+
+    def _script(self, messages):
+        time.sleep(self.latency_ms / 1000)
+        question = next(message.content for message in reversed(messages) if isinstance(message, HumanMessage))
+        tool_rounds = 0
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                break
+            if isinstance(message, ToolMessage):
+                tool_rounds += 1
+
+        if tool_rounds == 0:
+            return AIMessage(content='', tool_calls=[
+                {'name': 'retrieve_by_level', 'args': {'query': question, 'level': 3}, 'id': 'call_retrieve'}
+            ])
+        if tool_rounds == 1:
+            return AIMessage(content='', tool_calls=[
+                {'name': 'cite_from_documents', 'args': {'keyword': question, 'high_level': 3}, 'id': 'call_cite'}
+            ])
+        return AIMessage(content=' '.join(['answer'] * self.answer_words))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages)
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=message.usage_metadata, tool_call_chunks=[
+                {'name': call['name'], 'args': json.dumps(call['args']), 'id': call['id'], 'index': i}
+                for i, call in enumerate(message.tool_calls)
+            ]))
+            return
+        for i, word in enumerate(message.content.split(' ')):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + ' ', usage_metadata=message.usage_metadata if i == 0 else None))
+            if run_manager is not None:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
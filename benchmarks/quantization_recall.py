@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from vector_index import NumpyVectorStore, QuantizedVectorStore
+from agent import levels as LEVELS, TOP_K
+from langchain.docstore.document import Document
+
+# Recall@k of the quantized backend against exact search, per level with the agent's TOP_K, next to the memory
+# its codes take and the query latency of both. Queries are stored chunk vectors plus noise, so an existing index
+# can be measured without any embedding call:
+#
+#     python benchmarks/quantization_recall.py --persist-directory chroma_db
+#     python benchmarks/quantization_recall.py --synthetic 20000
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--persist-directory", type=str, default="chroma_db")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use N random clustered level-1 vectors instead of an index")
+    parser.add_argument("--dims", type=int, default=3072, help="Dimensions of the synthetic vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.5, help="Query noise relative to a stored vector")
+    parser.add_argument("--truncate-dims", type=str, default="3072,1024,512,256")
+    parser.add_argument("--quantizations", type=str, default="int8,binary")
+    parser.add_argument("--rescore-factors", type=str, default="1,4,10")
+    parser.add_argument("--output", type=str, default=None)
+    return parser.parse_args()
+
+def load_levels(args):
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(max(1, args.synthetic // 50), args.dims))
+        vectors = centers[rng.integers(0, len(centers), args.synthetic)] + 0.7 * rng.normal(size=(args.synthetic, args.dims))
+        documents = [Document(page_content='', metadata={'chunk_index': i}) for i in range(args.synthetic)]
+        return {1: NumpyVectorStore(documents, vectors, None)}
+
+    from langchain_chroma import Chroma
+    stores = {}
+    for level in LEVELS:
+        path = f"{args.persist_directory}/chunk_level_{level}"
+        if os.path.isdir(path):
+            stores[level] = NumpyVectorStore.from_chroma(Chroma(persist_directory=path), None)
+    return stores
+
+def queries_for(store, count, noise, rng):
+    rows = rng.integers(0, len(store), count)
+    queries = store.matrix[rows] + noise * rng.normal(size=(count, store.matrix.shape[1])) / np.sqrt(store.matrix.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def timed_search(store, queries, k):
+    results, samples = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = store.similarity_search_by_vector_with_relevance_scores(query, k=k)
+        samples.append(time.perf_counter() - start)
+        results.append({doc.metadata['chunk_index'] for doc, _ in hits})
+    return results, float(np.percentile(samples, 50) * 1000)
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(1)
+    stores = load_levels(args)
+    if not stores:
+        print(f"No index found in {args.persist_directory}, use --synthetic N to measure on random vectors.")
+        return
+
+    report = []
+    workdir = tempfile.mkdtemp(prefix='lina-quant-')
+    for level, exact in stores.items():
+        k = TOP_K[LEVELS.index(level)]
+        queries = queries_for(exact, args.queries, args.noise, rng)
+        truth, exact_ms = timed_search(exact, queries, k)
+        print(f"\nLevel {level}: {len(exact)} vectors x {exact.matrix.shape[1]} dims, k={k}, exact p50 {exact_ms:.2f} ms, {exact.matrix.nbytes / 2**20:.1f} MiB float32")
+        print(f"  {'dims':>5} {'quant':>7} {'rescore':>7} {'recall@k':>9} {'MiB':>8} {'ratio':>6} {'p50 ms':>7}")
+        for dims in map(int, args.truncate_dims.split(',')):
+            if dims > exact.matrix.shape[1]:
+                continue
+            for quantization in args.quantizations.split(','):
+                for factor in map(int, args.rescore_factors.split(',')):
+                    store = QuantizedVectorStore(
+                        exact.documents, exact.matrix, None, full_vectors_path=f"{workdir}/level_{level}.npy",
+                        truncate_dims=dims, quantization=quantization, rescore_factor=factor
+                    )
+                    found, ms = timed_search(store, queries, k)
+                    recall = float(np.mean([len(a & b) / max(1, len(a)) for a, b in zip(truth, found)]))
+                    row = {
+                        'level': level, 'k': k, 'truncate_dims': dims, 'quantization': quantization, 'rescore_factor': factor,
+                        'recall_at_k': recall, 'memory_bytes': store.memory_bytes(), 'float32_bytes': exact.matrix.nbytes,
+                        'p50_ms': ms, 'exact_p50_ms': exact_ms
+                    }
+                    report.append(row)
+                    print(f"  {dims:>5} {quantization:>7} {factor:>7} {recall:>9.3f} {row['memory_bytes'] / 2**20:>8.2f} {exact.matrix.nbytes / row['memory_bytes']:>5.0f}x {ms:>7.2f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fakes import HashingEmbeddings, FakeSummarizer, ScriptedToolChatModel, approximate_tokens
+from benchmarks.synthetic import generate_novel, sample_questions
+
+# Offline benchmark of ingestion and query latency. Every Azure client is replaced by a deterministic local fake,
+# the whole run happens in a temporary working directory and the results are written as JSON, e.g.
+#
+#     python benchmarks/run.py --volumes 1 --output results/base.json
+#     python benchmarks/run.py --volumes 1 --baseline results/base.json
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--volumes", type=int, default=1, help="1 is a single light novel volume, 10+ an omnibus")
+    parser.add_argument("--pages-per-volume", type=int, default=300)
+    parser.add_argument("--words-per-page", type=int, default=250)
+    parser.add_argument("--embedding-size", type=int, default=256)
+    parser.add_argument("--embedding-latency-ms", type=float, default=20.0, help="Per embed_query call and per embed_documents batch")
+    parser.add_argument("--summary-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=100.0)
+    parser.add_argument("--summary-failure-rate", type=float, default=0.0, help="Share of summary calls refused like a content filter would")
+    parser.add_argument("--library", action="store_true", help="Index every volume as its own library book instead of one omnibus")
+    parser.add_argument("--summarizer", type=str, default="llm", help="Summarizer backend used for the ingestion benchmark")
+    parser.add_argument("--grouping", type=str, default="fixed", help="fixed or adaptive (token budget) grouping of children per summary")
+    parser.add_argument("--compare-summarizers", type=str, default="llm,extractive,hybrid", help="Backends whose hierarchy build times are compared, empty to skip")
+    parser.add_argument("--tokens-per-minute", type=int, default=10**9, help="Summarizer rate limit, unlimited by default")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--backends", type=str, default="chroma,numpy")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results file to compare against")
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own prints")
+    return parser.parse_args()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64) * 1000
+    if len(samples) == 0:
+        return {'n': 0}
+    return {
+        'n': int(len(samples)),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p99_ms': float(np.percentile(samples, 99))
+    }
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def install_fakes(args):
+    # Must run before config is imported, it reads the Azure settings from the environment. The clients themselves are built
+    # on first use and look langchain_openai's classes up then, so they get the fakes
+    for name in ['OPENAI_API_KEY', 'OPENAI_API_ENDPOINT', 'OPENAI_API_VERSION']:
+        os.environ.setdefault(name, 'offline-benchmark' if name != 'OPENAI_API_ENDPOINT' else 'https://offline.invalid/')
+
+    embedding = HashingEmbeddings(size=args.embedding_size, latency_ms=args.embedding_latency_ms)
+    chat_model = ScriptedToolChatModel(latency_ms=args.llm_latency_ms)
+
+    import langchain_openai
+    langchain_openai.AzureOpenAIEmbeddings = lambda **kwargs: embedding
+    langchain_openai.AzureChatOpenAI = lambda **kwargs: chat_model
+
+    import utils
+    import context_manager
+    import hierarchy_builder
+    import summarizers
+    summarizer = FakeSummarizer(latency_ms=args.summary_latency_ms, failure_rate=args.summary_failure_rate)
+    utils.get_summarizer = lambda: summarizer
+    utils.count_tokens = approximate_tokens
+    context_manager.count_tokens = approximate_tokens
+    hierarchy_builder.count_tokens = approximate_tokens
+    utils.summary_rate_limiter = utils.TokenRateLimiter(args.tokens_per_minute)
+    hierarchy_builder.summary_rate_limiter = summarizers.summary_rate_limiter = utils.summary_rate_limiter
+    return embedding, summarizer
+
+def bench_summarizers(args, pages, quiet):
+    import embedding as indexing
+    from summarizers import HybridSummarizer, get_summarizer_backend
+
+    results = {}
+    for name in filter(None, args.compare_summarizers.split(',')):
+        # Each backend builds from scratch in its own directory, backups of one must not feed the next
+        os.makedirs(f"summarizer_{name}")
+        os.chdir(f"summarizer_{name}")
+        try:
+            summarizer = get_summarizer_backend(name)
+            with quiet():
+                chunks_map, seconds = timed(indexing.hierarchical_chunking, pages, summarizer=summarizer, grouping=args.grouping)
+        finally:
+            os.chdir('..')
+        results[name] = {
+            'hierarchical_chunking_s': seconds,
+            'chunks': {level: len(chunks) for level, chunks in chunks_map.items()},
+            'mean_summary_chars': float(np.mean([len(doc.page_content) for level, chunks in chunks_map.items() if level != 'level_1' for doc in chunks] or [0])),
+            'extractive_fallbacks': summarizer.fallbacks if isinstance(summarizer, HybridSummarizer) else None
+        }
+    return results
+
+def bench_ingestion(args, embedding, summarizer, quiet):
+    import embedding as indexing
+    from library import write_library_manifest
+
+    pages = generate_novel(volumes=args.volumes, pages_per_volume=args.pages_per_volume, words_per_page=args.words_per_page)
+    if not args.library:
+        return index_book(indexing, pages, None, args, embedding, summarizer, quiet)
+
+    # One book per volume, each with its own backups, tree and keyword index in the shared stores
+    write_library_manifest({'books': {}})
+    books = {}
+    for page in pages:
+        books.setdefault(os.path.splitext(page.metadata['source'])[0], []).append(page)
+    results = [index_book(indexing, book_pages, book_id, args, embedding, summarizer, quiet) for book_id, book_pages in books.items()]
+    totals = {
+        key: sum(result[key] for result in results)
+        for key in ['pages', 'hierarchical_chunking_s', 'embedd_chunks_s', 'reembed_unchanged_s', 'lexical_index_s', 'embedding_batches']
+    }
+    return {'books': len(books), **totals, 'summarizer_calls': summarizer.calls}
+
+def index_book(indexing, pages, book_id, args, embedding, summarizer, quiet):
+    from lexical_index import LexicalIndex
+    from summarizers import get_summarizer_backend
+    from embedding_backends import embedding_model_id
+
+    with quiet():
+        chunks_map, build_seconds = timed(
+            indexing.hierarchical_chunking, pages, summarizer=get_summarizer_backend(args.summarizer),
+            backup_directory=indexing.book_backup_directory(book_id), grouping=args.grouping
+        )
+    chunk_counts = {level: len(chunks) for level, chunks in chunks_map.items()}
+    total_chunks = sum(chunk_counts.values())
+
+    calls_before = embedding.calls
+    with quiet():
+        _, embed_seconds = timed(indexing.embedd_chunks, indexing.PERSIST_DIRECTORY, chunks_map, embedding, book_id=book_id)
+        # Nothing changed, so this measures the cost of the incremental diff alone
+        _, reembed_seconds = timed(indexing.embedd_chunks, indexing.PERSIST_DIRECTORY, chunks_map, embedding, book_id=book_id)
+
+    with quiet():
+        _, lexical_seconds = timed(LexicalIndex.from_documents, chunks_map['level_1'])
+        indexing.save_indexes(indexing.PERSIST_DIRECTORY, chunks_map, embedding, source='synthetic', book_id=book_id)
+    indexing.write_index_manifest(indexing.INDEX_MANIFEST_PATH, source='synthetic', embedding_model=embedding_model_id(), library=book_id is not None)
+
+    return {
+        'pages': len(pages),
+        'chunks': chunk_counts,
+        'hierarchical_chunking_s': build_seconds,
+        'summarizer_calls': summarizer.calls,
+        'embedd_chunks_s': embed_seconds,
+        'embedd_chunks_per_s': total_chunks / embed_seconds if embed_seconds else None,
+        'embedding_batches': embedding.calls - calls_before,
+        'reembed_unchanged_s': reembed_seconds,
+        'lexical_index_s': lexical_seconds,
+        'summarizers': bench_summarizers(args, pages, quiet) if book_id is None else {}
+    }
+
+def bench_retrieval(agent, questions, quiet):
+    high_level = max(agent.levels)
+    cases = {
+        'retrieve_by_level': lambda q: agent.retrieve_by_level.invoke({'query': q, 'level': 3}),
+        'retrieve_across_level': lambda q: agent.retrieve_across_level.invoke({'query': q, 'high_level': high_level, 'low_level': 2}),
+        'cite_from_documents': lambda q: agent.cite_from_documents.invoke({'keyword': q, 'high_level': high_level})
+    }
+    results = {}
+    with quiet():
+        for name, case in cases.items():
+            case(questions[0])
+            samples = [timed(case, question)[1] for question in questions]
+            results[name] = percentiles(samples)
+
+        # Quotes of six words taken from level-1 chunks, answered by the keyword index without any embedding call
+        library = agent.get_library()
+        index = agent.get_lexical_index() if library is None else library.lexical_index(next(iter(library.books)))
+        rows = np.random.default_rng(2).integers(0, len(index), len(questions))
+        quotes = [' '.join(index.document(row).page_content.split()[5:11]) for row in rows]
+        samples = [timed(cases['cite_from_documents'], quote)[1] for quote in quotes]
+        results['cite_exact_quote'] = percentiles(samples)
+    return results
+
+def bench_graph(agent, questions, quiet):
+    from langchain_core.messages import HumanMessage
+
+    app = agent.create_app()
+    with quiet():
+        sync_samples = [timed(app.invoke, {'messages': [HumanMessage(content=question)]})[1] for question in questions]
+
+        async def run_async():
+            samples = []
+            for question in questions:
+                start = time.perf_counter()
+                await app.ainvoke({'messages': [HumanMessage(content=question)]})
+                samples.append(time.perf_counter() - start)
+            return samples
+        async_samples = asyncio.run(run_async())
+    return {'invoke': percentiles(sync_samples), 'ainvoke': percentiles(async_samples)}
+
+def bench_prefetch(agent):
+    # Counters cover the retrieval and graph runs of one backend, then restart for the next
+    import prefetch
+    retriever = agent.get_retriever()
+    if retriever.prefetcher is not None:
+        retriever.prefetcher.executor.shutdown(wait=True)
+    results = {**prefetch.prefetch_metrics, 'hit_rate': prefetch.prefetch_hit_rate()}
+    for key in prefetch.prefetch_metrics:
+        prefetch.prefetch_metrics[key] = 0
+    return results
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({(baseline.get('commit') or 'unknown')[:10]}):")
+    current, previous = flatten(results), flatten(baseline)
+    for key in sorted(current):
+        if not (key.endswith('_s') or key.endswith('_ms') or key.endswith('_per_s')) or not previous.get(key):
+            continue
+        print(f"  {key:<55} {previous[key]:>12.3f} -> {current[key]:>12.3f}  ({current[key] / previous[key]:.2f}x)")
+
+def main():
+    args = parse_args()
+    quiet = contextlib.nullcontext if args.verbose else (lambda: contextlib.redirect_stdout(io.StringIO()))
+
+    workdir = tempfile.mkdtemp(prefix='lina-bench-')
+    os.makedirs(f"{workdir}/configs")
+    shutil.copy(f"{REPO_ROOT}/configs/prompts.txt", f"{workdir}/configs/prompts.txt")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+
+    try:
+        embedding, summarizer = install_fakes(args)
+        results = {
+            'commit': git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': vars(args),
+        }
+
+        print(f"Ingesting {args.volumes} synthetic volume(s) in {workdir}")
+        results['ingestion'] = bench_ingestion(args, embedding, summarizer, quiet)
+
+        questions = sample_questions(args.queries)
+        results['startup'] = {}
+        results['retrieval'] = {}
+        results['graph'] = {}
+        results['prefetch'] = {}
+        for backend in args.backends.split(','):
+            # agent reads RETRIEVAL_BACKEND at import time and caches the stores it builds on first use, so each backend gets a fresh import
+            os.environ['RETRIEVAL_BACKEND'] = backend
+            sys.modules.pop('agent', None)
+            with quiet():
+                import_start = time.perf_counter()
+                import agent
+                import_seconds = time.perf_counter() - import_start
+                _, warm_up_seconds = timed(agent.warm_up)
+            results['startup'][backend] = {'import_agent_s': import_seconds, 'warm_up_s': warm_up_seconds}
+            print(f"Querying with the {backend} backend")
+            results['retrieval'][backend] = bench_retrieval(agent, questions, quiet)
+            results['graph'][backend] = bench_graph(agent, questions[:args.turns], quiet)
+            results['prefetch'][backend] = bench_prefetch(agent)
+
+        import telemetry
+        if telemetry.enabled:
+            results['telemetry'] = telemetry.snapshot()
+    finally:
+        os.chdir(previous_dir)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"Results written to {args.output}")
+    else:
+        print(output)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
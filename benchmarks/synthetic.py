@@ -0,0 +1,37 @@
+import random
+
+from langchain.docstore.document import Document
+
+CHARACTERS = ['Hachiman', 'Yukino', 'Yui', 'Komachi', 'Shizuka', 'Saika', 'Zaimokuza', 'Hayato', 'Yumiko', 'Hina', 'Iroha', 'Haruno']
+PLACES = ['the clubroom', 'the rooftop', 'the station', 'the library', 'the tennis court', 'the convenience store', 'the classroom', 'the beach']
+ACTIONS = ['argued with', 'walked home with', 'ignored', 'helped', 'teased', 'waited for', 'wrote a letter to', 'apologized to']
+TOPICS = ['the request', 'the school festival', 'the summer camp', 'a misunderstanding', 'the cooking lesson', 'the election', 'friendship', 'the past']
+MOODS = ['quietly', 'angrily', 'awkwardly', 'with a sigh', 'without a word', 'cheerfully', 'reluctantly']
+
+def sentence(rng):
+    a, b = rng.sample(CHARACTERS, 2)
+    return f"{a} {rng.choice(ACTIONS)} {b} at {rng.choice(PLACES)} about {rng.choice(TOPICS)} {rng.choice(MOODS)}."
+
+def generate_novel(volumes=1, pages_per_volume=300, words_per_page=250, chapters_per_volume=8, seed=0):
+    '''
+    Returns cleaned pages as Documents shaped like PyPDFLoader output (source, page), from one volume up to an omnibus.
+    '''
+    rng = random.Random(seed)
+    pages = []
+    pages_per_chapter = max(1, pages_per_volume // chapters_per_volume)
+    for volume in range(volumes):
+        for page_number in range(pages_per_volume):
+            words = []
+            if page_number % pages_per_chapter == 0:
+                words = f"Volume {volume + 1} Chapter {page_number // pages_per_chapter + 1}.".split()
+            while len(words) < words_per_page:
+                words.extend(sentence(rng).split())
+            pages.append(Document(
+                page_content=' '.join(words),
+                metadata={'source': f"synthetic_volume_{volume + 1}.pdf", 'page': len(pages)}
+            ))
+    return pages
+
+def sample_questions(count=50, seed=1):
+    rng = random.Random(seed)
+    return [f"What happened when {rng.choice(CHARACTERS)} met {rng.choice(CHARACTERS)} at {rng.choice(PLACES)}?" for _ in range(count)]
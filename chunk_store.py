@@ -0,0 +1,195 @@
+import os
+import ast
+import json
+import mmap
+import struct
+import argparse
+from bisect import bisect_left
+
+from langchain.docstore.document import Document
+
+# Backup layout for one level:
+#   chunks_level_N.jsonl : a header line {"format", "version"} followed by one {"page_content", "metadata"} record per line
+#   chunks_level_N.idx   : header (magic, version, count), then `count` sorted chunk_index values, then `count` byte offsets
+FORMAT_NAME = 'lina-chunks'
+FORMAT_VERSION = 1
+INDEX_MAGIC = b'LNIX'
+INDEX_HEADER = struct.Struct('<4sIQ')
+OFFSET_SIZE = 8
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
+
+def encode_record(doc):
+    record = {'page_content': doc.page_content, 'metadata': doc.metadata}
+    return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+def decode_record(line):
+    record = json.loads(line)
+    return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+def check_header(line, path):
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('format') != FORMAT_NAME:
+        raise ValueError(f"{path} is not a chunk backup.")
+    if header.get('version', 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} uses backup format version {header['version']}, this build reads up to {FORMAT_VERSION}.")
+
+def write_index(path, entries):
+    entries = sorted(entries)
+    with open(path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, FORMAT_VERSION, len(entries)))
+        f.write(struct.pack(f'<{len(entries)}q', *[chunk_index for chunk_index, _ in entries]))
+        f.write(struct.pack(f'<{len(entries)}q', *[offset for _, offset in entries]))
+
+def write_chunks(chunks, output_path):
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    entries = []
+    with open(tmp_path, 'wb') as f:
+        f.write((json.dumps({'format': FORMAT_NAME, 'version': FORMAT_VERSION}) + '\n').encode('utf-8'))
+        for position, doc in enumerate(chunks):
+            entries.append((int(doc.metadata.get('chunk_index', position)), f.tell()))
+            f.write(encode_record(doc))
+    write_index(index_path(tmp_path), entries)
+    os.replace(index_path(tmp_path), index_path(output_path))
+    os.replace(tmp_path, output_path)
+
+def iter_chunks(input_path):
+    with open(input_path, 'rb') as f:
+        check_header(f.readline(), input_path)
+        for line in f:
+            if line.strip():
+                yield decode_record(line)
+
+def read_chunks(input_path):
+    return list(iter_chunks(input_path))
+
+class ChunkBackup:
+    '''
+    Memory-mapped view over a chunk backup: iterate it like a list or fetch one chunk by chunk_index without parsing the rest.
+    '''
+    def __init__(self, path):
+        self.path = path
+        # write_chunks writes the index after the records, an older index belongs to a previous version of the file
+        if not os.path.exists(index_path(path)) or os.path.getmtime(index_path(path)) < os.path.getmtime(path):
+            self._rebuild_index()
+
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        check_header(self.data[:self.data.find(b'\n')], path)
+
+        self.index_file = open(index_path(path), 'rb')
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC or version > FORMAT_VERSION:
+            raise ValueError(f"{index_path(path)} is not a supported chunk index.")
+        keys_start = INDEX_HEADER.size
+        offsets_start = keys_start + count * OFFSET_SIZE
+        self.keys = memoryview(self.index)[keys_start:offsets_start].cast('q')
+        self.offsets = memoryview(self.index)[offsets_start:offsets_start + count * OFFSET_SIZE].cast('q')
+
+    def _rebuild_index(self):
+        entries = []
+        with open(self.path, 'rb') as f:
+            check_header(f.readline(), self.path)
+            position = 0
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    doc = decode_record(line)
+                    entries.append((int(doc.metadata.get('chunk_index', position)), offset))
+                    position += 1
+        write_index(index_path(self.path), entries)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, chunk_index):
+        position = bisect_left(self.keys, chunk_index)
+        return position < len(self.keys) and self.keys[position] == chunk_index
+
+    def _read_at(self, offset):
+        end = self.data.find(b'\n', offset)
+        return decode_record(self.data[offset:end if end != -1 else len(self.data)])
+
+    def __getitem__(self, chunk_index):
+        position = bisect_left(self.keys, chunk_index)
+        if position == len(self.keys) or self.keys[position] != chunk_index:
+            raise KeyError(f"chunk_index {chunk_index} not found in {self.path}.")
+        return self._read_at(self.offsets[position])
+
+    def get_many(self, chunk_indices):
+        return [self[chunk_index] for chunk_index in chunk_indices if chunk_index in self]
+
+    def __iter__(self):
+        for offset in sorted(self.offsets):
+            yield self._read_at(offset)
+
+    def close(self):
+        self.keys.release()
+        self.offsets.release()
+        self.index.close()
+        self.index_file.close()
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parse_legacy_line(line):
+    # Old backups hold repr(Document(...)); only literal keyword arguments are accepted, nothing is evaluated
+    node = ast.parse(line, mode='eval').body
+    if not isinstance(node, ast.Call) or getattr(node.func, 'id', None) != 'Document':
+        raise ValueError(f"Unexpected record in legacy backup: {line[:80]}")
+    kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in node.keywords}
+    return Document(page_content=kwargs.get('page_content', ''), metadata=kwargs.get('metadata') or {})
+
+def migrate_legacy_backup(txt_path):
+    output_path = os.path.splitext(txt_path)[0] + '.jsonl'
+    chunks = []
+    with open(txt_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                chunks.append(parse_legacy_line(line))
+    write_chunks(chunks, output_path)
+    print(f"Migrated {txt_path} -> {output_path} ({len(chunks)} chunks)")
+    return output_path
+
+def migrate_backup_directory(directory):
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('chunks_level_') and name.endswith('.txt'):
+            txt_path = os.path.join(directory, name)
+            if not os.path.exists(os.path.splitext(txt_path)[0] + '.jsonl'):
+                migrate_legacy_backup(txt_path)
+
+def show_chunk(directory, level, chunk_index):
+    # One chunk straight from the backup, the rest of the level is never parsed
+    with ChunkBackup(os.path.join(directory, f"chunks_level_{level}.jsonl")) as backup:
+        doc = backup[chunk_index]
+    print(json.dumps(doc.metadata, ensure_ascii=False))
+    print(doc.page_content)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--migrate", type=str, default="backup", help="Directory holding legacy chunks_level_N.txt backups")
+    parser.add_argument("--show", type=str, default=None, help="LEVEL:CHUNK_INDEX, print that chunk from the backups in --migrate's directory")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.show:
+        level, chunk_index = args.show.split(':')
+        show_chunk(args.migrate, int(level), int(chunk_index))
+    else:
+        migrate_backup_directory(args.migrate)
@@ -0,0 +1,29 @@
+import os
+from dotenv import load_dotenv
+
+# Settings shared by indexing (embedding.py) and the chat app (agent.py), kept free of heavy imports
+load_dotenv()
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+OPENAI_API_ENDPOINT = os.environ.get('OPENAI_API_ENDPOINT')
+OPENAI_API_VERSION = os.environ.get('OPENAI_API_VERSION')
+
+PERSIST_DIRECTORY = 'chroma_db'
+HIERARCHY_TREE_PATH = f'{PERSIST_DIRECTORY}/hierarchy_tree.npz'
+INDEX_MANIFEST_PATH = f'{PERSIST_DIRECTORY}/index_manifest.json'
+LEXICAL_INDEX_PATH = f'{PERSIST_DIRECTORY}/lexical_index.npz'
+# Library mode (embedding.py --book-id): books share the level stores, namespaced by a book_id metadata field
+LIBRARY_MANIFEST_PATH = f'{PERSIST_DIRECTORY}/library.json'
+LIBRARY_ROUTING_PATH = f'{PERSIST_DIRECTORY}/library_routing.npz'
+LIBRARY_DIRECTORY = f'{PERSIST_DIRECTORY}/books'
+EMBEDDING_MODEL = 'text-embedding-3-large'
+
+# 'azure' uses EMBEDDING_MODEL on Azure OpenAI, 'local' runs a sentence-transformers model on this machine's CPU
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'azure')
+
+LOCAL_EMBEDDING_CONFIG = {
+    'model_name' : os.environ.get('LOCAL_EMBEDDING_MODEL', 'BAAI/bge-small-en-v1.5'),
+    # 'onnx' (onnxruntime) or 'torch'
+    'runtime' : os.environ.get('LOCAL_EMBEDDING_RUNTIME', 'onnx'),
+    'batch_size' : 64,
+    'threads' : os.cpu_count() or 1
+}
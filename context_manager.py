@@ -0,0 +1,132 @@
+import re
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from tokens import count_tokens
+import telemetry
+
+CONTEXT_CONFIG = {
+    'max_prompt_tokens' : 24000,
+    'history_answer_tokens' : 200,
+    'message_overhead_tokens' : 4
+}
+
+# Tool results are formatted as "Document i [L<level> #<chunk_index>( <book_id>)] ...:\n<text>", the tag identifies a chunk across calls
+DOCUMENT_HEADER = re.compile(r'^(Document \d+ \[(L\d+ #\d+(?: [^\]]+)?)\][^\n]*):\n', re.M)
+
+context_metrics = {
+    'calls' : 0,
+    'tokens_before' : 0,
+    'tokens_after' : 0,
+    'duplicates_removed' : 0,
+    'messages_compacted' : 0
+}
+
+def message_tokens(message):
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return count_tokens(content) + CONTEXT_CONFIG['message_overhead_tokens']
+
+def split_documents(content):
+    # (text before the first document, e.g. the "Search path" line, [(tag, header, body)])
+    matches = list(DOCUMENT_HEADER.finditer(content))
+    if not matches:
+        return None
+    blocks = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        blocks.append((match.group(2), match.group(1), content[match.end():end].strip()))
+    return content[:matches[0].start()], blocks
+
+def current_turn_start(messages):
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return i
+    return 0
+
+def deduplicate_turn(messages, start):
+    seen = set()
+    replacements = {}
+    for message in messages[start:]:
+        if not isinstance(message, ToolMessage) or not isinstance(message.content, str):
+            continue
+        split = split_documents(message.content)
+        if split is None:
+            continue
+        preamble, blocks = split
+        parts = []
+        changed = False
+        for ref, header, body in blocks:
+            reference = f"{header} already shown above."
+            if ref in seen and len(reference) < len(header) + len(body):
+                parts.append(reference)
+                changed = True
+            else:
+                seen.add(ref)
+                parts.append(f"{header}:\n{body}")
+        if changed:
+            replacements[message.id] = message.model_copy(update={'content': preamble + "\n\n".join(parts)})
+    return replacements
+
+def compact_history(messages, start, replacements, total_tokens):
+    budget = CONTEXT_CONFIG['max_prompt_tokens']
+    for message in messages[:start]:
+        if total_tokens <= budget:
+            break
+        current = replacements.get(message.id, message)
+        if isinstance(current, ToolMessage):
+            content = "[Earlier tool result removed to save context.]"
+        elif isinstance(current, AIMessage) and isinstance(current.content, str) and message_tokens(current) > CONTEXT_CONFIG['history_answer_tokens']:
+            words = current.content.split()
+            content = " ".join(words[:CONTEXT_CONFIG['history_answer_tokens'] // 2]) + " ..."
+        else:
+            continue
+        compacted = current.model_copy(update={'content': content})
+        total_tokens -= message_tokens(current) - message_tokens(compacted)
+        replacements[message.id] = compacted
+        context_metrics['messages_compacted'] += 1
+    return total_tokens
+
+def compact_turn(messages, start, replacements, total_tokens):
+    # Still over budget with the history compacted: the current turn's oldest tool results go too, the latest ones are kept longest
+    budget = CONTEXT_CONFIG['max_prompt_tokens']
+    for message in messages[start:]:
+        if total_tokens <= budget:
+            break
+        current = replacements.get(message.id, message)
+        if not isinstance(current, ToolMessage):
+            continue
+        compacted = current.model_copy(update={'content': "[Tool result removed to save context, search again if you still need it.]"})
+        saved = message_tokens(current) - message_tokens(compacted)
+        if saved <= 0:
+            continue
+        total_tokens -= saved
+        replacements[message.id] = compacted
+        context_metrics['messages_compacted'] += 1
+    return total_tokens
+
+def manage_context(messages):
+    '''
+    Returns the messages that must be replaced (same id) so the next LLM call fits the token budget:
+    chunks already shown in the current turn become short references, then old turns are compacted oldest first,
+    then the current turn's own tool results, oldest first.
+    '''
+    messages = list(messages)
+    start = current_turn_start(messages)
+    tokens_before = sum(message_tokens(message) for message in messages)
+
+    replacements = deduplicate_turn(messages, start)
+    total_tokens = tokens_before
+    for message_id, replacement in replacements.items():
+        original = next(message for message in messages if message.id == message_id)
+        total_tokens -= message_tokens(original) - message_tokens(replacement)
+        context_metrics['duplicates_removed'] += replacement.content.count("already shown above.") - original.content.count("already shown above.")
+
+    total_tokens = compact_history(messages, start, replacements, total_tokens)
+    total_tokens = compact_turn(messages, start, replacements, total_tokens)
+
+    context_metrics['calls'] += 1
+    context_metrics['tokens_before'] += tokens_before
+    context_metrics['tokens_after'] += total_tokens
+    if tokens_before != total_tokens:
+        telemetry.record('context_tokens_saved', tokens_before - total_tokens)
+    return list(replacements.values())
@@ -1,13 +1,27 @@
 from utils import *
 import os
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import AzureOpenAIEmbeddings
 from langchain_chroma import Chroma
 import argparse
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from hierarchy_builder import PipelinedHierarchyBuilder, TokenBudgetGrouping
+from embedding_cache import CachedEmbeddings, content_hash
+from hierarchy_tree import HierarchyTree, node_id
+from ingestion import stream_documents, stream_chunks
+from summarizers import SUMMARIZERS, HybridSummarizer, get_summarizer_backend
+from config import PERSIST_DIRECTORY, HIERARCHY_TREE_PATH, INDEX_MANIFEST_PATH, LEXICAL_INDEX_PATH, LIBRARY_MANIFEST_PATH
+from lexical_index import LexicalIndex
+from vector_index import export_full_vectors, full_vectors_path
+from library import check_book_id, book_tree_path, book_lexical_index_path, register_book, reset_library, write_library_manifest
+from embedding_backends import build_embedding, embedding_model_id, indexed_model_id, LEGACY_EMBEDDING_MODEL_ID
 
-PERSIST_DIRECTORY = 'chroma_db'
-EMBEDDING_MODEL = 'text-embedding-3-large'
 BACKUP_DIRECTORY = 'backup'
+EMBEDDING_CACHE_PATH = 'cache/embeddings.sqlite'
+INDEX_BATCH_SIZE = 1000
 
 HIERARCHICAL_CONFIG  = {
     'level_2' : 5,
@@ -16,82 +30,238 @@ HIERARCHICAL_CONFIG  = {
     'level_5' : 3
 }
 
+# --grouping adaptive: children are packed up to a token budget per parent instead of HIERARCHICAL_CONFIG's fixed counts,
+# and a group holding part of a chapter closes at the next chapter heading / scene break. Budgets sit a little above the fixed groups' average
+# (5 level-1 chunks of ~120 tokens, 3 summaries of ~150) so calls are fewer and fuller while the fan-out stays close
+GROUPING_CONFIG = {
+    'target_tokens' : {
+        'level_2' : 800,
+        'level_3' : 600,
+        'level_4' : 600,
+        'level_5' : 600
+    },
+    'min_children' : 2,
+    'max_children' : 12
+}
+
 TEXT_SPLITTER_CONFIG = {
     'chunk_size' : 500,
     'chunk_overlap' : 100
 }
 
-def split_into_chunks(data):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=TEXT_SPLITTER_CONFIG['chunk_size'], chunk_overlap=TEXT_SPLITTER_CONFIG['chunk_overlap'])
-    return splitter.split_documents(data)
+def text_splitter():
+    return RecursiveCharacterTextSplitter(chunk_size=TEXT_SPLITTER_CONFIG['chunk_size'], chunk_overlap=TEXT_SPLITTER_CONFIG['chunk_overlap'])
 
-def hierarchical_chunking(data):
-    if os.path.exists(f"{BACKUP_DIRECTORY}/chunks_level_1.txt"):
-        print("Using backup chunks_level_1.txt")
-        chunks_level_1 = read_chunks(f"{BACKUP_DIRECTORY}/chunks_level_1.txt")
-    else:
-        chunks_level_1 = split_into_chunks(data)
-        chunks_level_1 = add_chunk_index(chunks_level_1)
-        print(f"Completed chunking at level 1 with a total {len(chunks_level_1)} chunks.\n")
-        write_chunks(chunks_level_1, f"{BACKUP_DIRECTORY}/chunks_level_1.txt")
-
-    if os.path.exists(f"{BACKUP_DIRECTORY}/chunks_level_2.txt"):
-        print("Using backup chunks_level_2.txt")
-        chunks_level_2 = read_chunks(f"{BACKUP_DIRECTORY}/chunks_level_2.txt")
-    else:
-        chunks_level_2 = up_level_chunking(chunks_level_1, n_content_chunks=HIERARCHICAL_CONFIG['level_2'], level=2, log_error=True)
-        print(f"Completed chunking at level 2 with a total {len(chunks_level_2)} chunks.\n")
-        write_chunks(chunks_level_2, f"{BACKUP_DIRECTORY}/chunks_level_2.txt")
+def book_backup_directory(book_id=None):
+    # Library books keep their backups apart, so rebuilding one never reuses another's chunks
+    return BACKUP_DIRECTORY if book_id is None else f"{BACKUP_DIRECTORY}/{book_id}"
 
-    if os.path.exists(f"{BACKUP_DIRECTORY}/chunks_level_3.txt"):
-        print("Using backup chunks_level_3.txt")
-        chunks_level_3 = read_chunks(f"{BACKUP_DIRECTORY}/chunks_level_3.txt")
-    else:
-        chunks_level_3 = up_level_chunking(chunks_level_2, n_content_chunks=HIERARCHICAL_CONFIG['level_3'], level=3, log_error=True)
-        print(f"Completed chunking at level 3 with a total {len(chunks_level_3)} chunks.\n")
-        write_chunks(chunks_level_3, f"{BACKUP_DIRECTORY}/chunks_level_3.txt")
+def backup_path(level, directory=BACKUP_DIRECTORY):
+    return f"{directory}/chunks_level_{level}.jsonl"
 
-    if os.path.exists(f"{BACKUP_DIRECTORY}/chunks_level_4.txt"):
-        print("Using backup chunks_level_4.txt")
-        chunks_level_4 = read_chunks(f"{BACKUP_DIRECTORY}/chunks_level_4.txt")
-    else:
-        chunks_level_4 = up_level_chunking(chunks_level_3, n_content_chunks=HIERARCHICAL_CONFIG['level_4'], level=4, log_error=True)
-        print(f"Completed chunking at level 4 with a total {len(chunks_level_4)} chunks.\n")
-        write_chunks(chunks_level_4, f"{BACKUP_DIRECTORY}/chunks_level_4.txt")
+def legacy_backup_path(level, directory=BACKUP_DIRECTORY):
+    return f"{directory}/chunks_level_{level}.txt"
 
-    if os.path.exists(f"{BACKUP_DIRECTORY}/chunks_level_5.txt"):
-        print("Using backup chunks_level_5.txt")
-        chunks_level_5 = read_chunks(f"{BACKUP_DIRECTORY}/chunks_level_5.txt")
-    else:
-        chunks_level_5 = up_level_chunking(chunks_level_4, n_content_chunks=HIERARCHICAL_CONFIG['level_5'], level=5, log_error=True)
-        print(f"Completed chunking at level 5 with a total {len(chunks_level_5)} chunks.\n")
-        write_chunks(chunks_level_5, f"{BACKUP_DIRECTORY}/chunks_level_5.txt")
-
-    chunks_map = {
-        'level_1': chunks_level_1,
-        'level_2': chunks_level_2,
-        'level_3': chunks_level_3,
-        'level_4': chunks_level_4,
-        'level_5': chunks_level_5
+def has_backup(level, directory=BACKUP_DIRECTORY):
+    return os.path.exists(backup_path(level, directory)) or os.path.exists(legacy_backup_path(level, directory))
+
+def read_level_backup(level, directory=BACKUP_DIRECTORY):
+    if not os.path.exists(backup_path(level, directory)):
+        migrate_legacy_backup(legacy_backup_path(level, directory))
+    print(f"Using backup {backup_path(level, directory)}")
+    # Memory-mapped: records are decoded straight from the mapping instead of through buffered line reads
+    with ChunkBackup(backup_path(level, directory)) as backup:
+        return list(backup)
+
+def write_level_backup(level, chunks, directory=BACKUP_DIRECTORY):
+    write_chunks(chunks, backup_path(level, directory))
+
+def build_groupings(mode):
+    if mode == 'fixed':
+        return None
+    if mode != 'adaptive':
+        raise ValueError(f"Unknown grouping '{mode}', expected 'fixed' or 'adaptive'.")
+    return {
+        int(level.split('_')[1]): TokenBudgetGrouping(target_tokens, GROUPING_CONFIG['min_children'], GROUPING_CONFIG['max_children'])
+        for level, target_tokens in GROUPING_CONFIG['target_tokens'].items()
     }
 
+def hierarchical_chunking(data, on_node=None, summarizer=None, backup_directory=BACKUP_DIRECTORY, grouping='fixed'):
+    '''
+    data is any iterable of cleaned pages (a list or ingestion.stream_documents), it is only read when level 1 has no backup.
+    '''
+    chunks_map = {}
+    level_1_stream = None
+    if has_backup(1, backup_directory):
+        chunks_map['level_1'] = read_level_backup(1, backup_directory)
+        for level in range(2, len(HIERARCHICAL_CONFIG) + 2):
+            if not has_backup(level, backup_directory):
+                break
+            chunks_map[f'level_{level}'] = read_level_backup(level, backup_directory)
+    else:
+        level_1_stream = stream_chunks(data, text_splitter())
+
+    on_level = lambda level, chunks: write_level_backup(level, chunks, backup_directory)
+    builder = PipelinedHierarchyBuilder(HIERARCHICAL_CONFIG, on_node=on_node, on_level=on_level, summarizer=summarizer, groupings=build_groupings(grouping))
+    chunks_map = builder.build(chunks_map, level_1_stream=level_1_stream)
+
     for level, chunks in chunks_map.items():
         retype_metadata(chunks)
 
     return chunks_map
 
-def embedd_chunks(persist_directory, chunks_map, embedding):
+def prepare_for_index(doc, book_id=None):
+    doc = Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+    if book_id is not None:
+        doc.metadata['book_id'] = book_id
+    retype_metadata([doc])
+    doc.metadata['content_hash'] = content_hash(doc)
+    return doc
+
+def chunk_id(level, doc):
+    return node_id(level, doc.metadata['chunk_index'], doc.metadata.get('book_id'))
+
+def open_store(persist_directory, level, embedding):
+    return Chroma(embedding_function=embedding, persist_directory=f"{persist_directory}/chunk_{level}")
+
+def upsert_changed(store, level, docs, stored_hashes):
+    changed = [doc for doc in docs if stored_hashes.get(chunk_id(level, doc)) != doc.metadata['content_hash']]
+    for start in range(0, len(changed), INDEX_BATCH_SIZE):
+        batch = changed[start : start + INDEX_BATCH_SIZE]
+        store.add_documents(batch, ids=[chunk_id(level, doc) for doc in batch])
+    return len(changed)
+
+def stored_content_hashes(store, ids=None, book_id=None):
+    stored = store.get(ids=ids, where={'book_id': book_id} if book_id is not None else None, include=['metadatas'])
+    return {id: (metadata or {}).get('content_hash') for id, metadata in zip(stored['ids'], stored['metadatas'])}
+
+class StreamingEmbedder:
+    '''
+    Receives finished hierarchy nodes while the build is still running and embeds them in batches on a background thread.
+    Chunks whose content hash is already stored are skipped, embedd_chunks reconciles the rest afterwards.
+    '''
+    def __init__(self, persist_directory, embedding, batch_size=64, book_id=None):
+        self.persist_directory = persist_directory
+        self.embedding = embedding
+        self.book_id = book_id
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.stores = {}
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.embedded = 0
+        self.seconds = 0.0
+
+    def add(self, level, doc):
+        buffer = self.buffers.setdefault(level, [])
+        buffer.append(prepare_for_index(doc, self.book_id))
+        if len(buffer) >= self.batch_size:
+            self.flush(level)
+
+    def flush(self, level):
+        docs = self.buffers.pop(level, [])
+        if docs:
+            self.futures.append(self.executor.submit(self._write, f"level_{level}", docs))
+
+    def _write(self, level, docs):
+        if level not in self.stores:
+            self.stores[level] = open_store(self.persist_directory, level, self.embedding)
+        store = self.stores[level]
+        start = time.perf_counter()
+        self.embedded += upsert_changed(store, level, docs, stored_content_hashes(store, ids=[chunk_id(level, doc) for doc in docs]))
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        for level in list(self.buffers):
+            self.flush(level)
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        if self.embedded:
+            print(f"Embedded {self.embedded} chunks during the build ({self.embedded / self.seconds:.1f} chunks/s).")
+
+def embedd_chunks(persist_directory, chunks_map, embedding, book_id=None):
+    # In library mode only the chunks of book_id are compared, added and removed
+    total_embedded, total_seconds = 0, 0.0
     for level, chunks in chunks_map.items():
         print(f"Embedding chunks {level}")
-        directory = f"{persist_directory}/chunk_{level}"
-        if os.path.exists(directory):
-            print(f"Skipping {level} (already embedded).")
-            continue
-        Chroma.from_documents(documents=chunks, embedding = embedding, persist_directory=directory)
+        start = time.perf_counter()
+        docs = [prepare_for_index(doc, book_id) for doc in chunks]
+        current_ids = {chunk_id(level, doc) for doc in docs}
+
+        store = open_store(persist_directory, level, embedding)
+        stored_hashes = stored_content_hashes(store, book_id=book_id)
+        stale = [id for id in stored_hashes if id not in current_ids]
+        if stale:
+            store.delete(ids=stale)
+        embedded = upsert_changed(store, level, docs, stored_hashes)
+        seconds = time.perf_counter() - start
+        total_embedded += embedded
+        total_seconds += seconds
+        throughput = f", {embedded / seconds:.1f} chunks/s" if embedded else ""
+        print(f"{level}: {embedded} new or changed, {len(stale)} removed, {len(docs) - embedded} unchanged ({seconds:.1f}s{throughput}).")
+    if total_embedded:
+        print(f"Embedded {total_embedded} chunks at {total_embedded / total_seconds:.1f} chunks/s.")
+
+def reset_stores_for_model(persist_directory, model_id, embedding):
+    # Stored vectors from another model cannot be reused (content hashes would match, dimensions may not)
+    indexed = indexed_model_id(INDEX_MANIFEST_PATH)
+    if indexed is None and os.path.isdir(persist_directory):
+        indexed = LEGACY_EMBEDDING_MODEL_ID
+    if indexed is None or indexed == model_id:
+        return
+    print(f"Index was built with '{indexed}', re-embedding every level with '{model_id}'.")
+    for level in range(1, len(HIERARCHICAL_CONFIG) + 2):
+        open_store(persist_directory, f"level_{level}", embedding).delete_collection()
+    if os.path.exists(LIBRARY_MANIFEST_PATH):
+        # Every book's vectors are gone, each one has to be re-run (its backups skip the summaries)
+        print("The library was emptied, run embedding.py again for every book.")
+        reset_library()
+
+def save_indexes(persist_directory, chunks_map, embedding, source, book_id=None):
+    '''
+    Full vectors, tree and keyword index used by the retriever. Library books get their own, and their top-level summary vectors
+    are registered so queries can be routed to them.
+    '''
+    # The quantized backend memory-maps these at startup instead of exporting every level from Chroma on each start
+    for level in chunks_map:
+        export_full_vectors(open_store(persist_directory, level, embedding), full_vectors_path(persist_directory, int(level.split('_')[1])))
+
+    tree = HierarchyTree.from_chunks_map(chunks_map)
+    lexical_index = LexicalIndex.from_documents(chunks_map['level_1'])
+    if book_id is None:
+        tree.save(HIERARCHY_TREE_PATH)
+        lexical_index.save(LEXICAL_INDEX_PATH)
+        return
+
+    tree.save(book_tree_path(book_id))
+    lexical_index.save(book_lexical_index_path(book_id))
+    top_level = max((level for level, chunks in chunks_map.items() if chunks), key=lambda level: int(level.split('_')[1]))
+    summaries = open_store(persist_directory, top_level, embedding).get(where={'book_id': book_id}, include=['embeddings'])
+    register_book(book_id, summaries['embeddings'], source=source, chunks={level: len(chunks) for level, chunks in chunks_map.items()})
+
+def check_index_layout(persist_directory, book_id):
+    # A directory holds either one book (the original layout) or a library, never both
+    library = os.path.exists(LIBRARY_MANIFEST_PATH)
+    if book_id is None and library:
+        return f"{persist_directory} is a library, pass --book-id to add or update a book."
+    if book_id is not None and not library and os.path.isdir(persist_directory) and os.listdir(persist_directory):
+        return f"{persist_directory} holds a single-book index, move it away before starting a library."
+    return None
+
+def write_index_manifest(path, **fields):
+    manifest = {'build_id': uuid.uuid4().hex, 'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'), **fields}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", type=str, default="data/Oregairu Volume 1.pdf")
+    parser.add_argument("--summarizer", type=str, default="llm", choices=list(SUMMARIZERS), help="How levels 2-5 are summarized: llm, local extractive TextRank, or llm with extractive fallback")
+    parser.add_argument("--workers", type=int, default=None, help="Processes extracting PDF pages (default: one per CPU)")
+    parser.add_argument("--grouping", type=str, default="fixed", choices=["fixed", "adaptive"], help="Children per summary: HIERARCHICAL_CONFIG counts, or packed up to a token budget respecting chapters")
+    parser.add_argument("--book-id", type=str, default=None, help="Add the file to the library under this id (e.g. oregairu-v1) instead of building a single-book index")
     return parser.parse_args()
 
 def main():
@@ -102,20 +272,37 @@ def main():
         print(f"Could not find {file_path}")
         return
 
-    data = load_documents(file_path)
-    data = clean_data(data)
+    book_id = check_book_id(args.book_id) if args.book_id is not None else None
+    layout_error = check_index_layout(PERSIST_DIRECTORY, book_id)
+    if layout_error:
+        print(layout_error)
+        return
+
+    data = stream_documents(file_path, workers=args.workers)
+
+    model_id = embedding_model_id()
+    # Azure cache keys predate the backend prefix, keep them valid
+    embedding = CachedEmbeddings(build_embedding(), model_id.removeprefix('azure:'), EMBEDDING_CACHE_PATH)
+    reset_stores_for_model(PERSIST_DIRECTORY, model_id, embedding)
+    if book_id is not None and not os.path.exists(LIBRARY_MANIFEST_PATH):
+        write_library_manifest({'books': {}})
+
+    summarizer = get_summarizer_backend(args.summarizer)
 
     print("\n=====Hirerachical Chunking=====\n")
-    chunks_map = hierarchical_chunking(data)
+    streaming_embedder = StreamingEmbedder(PERSIST_DIRECTORY, embedding, book_id=book_id)
+    try:
+        chunks_map = hierarchical_chunking(data, on_node=streaming_embedder.add, summarizer=summarizer, backup_directory=book_backup_directory(book_id), grouping=args.grouping)
+    finally:
+        streaming_embedder.close()
+    if isinstance(summarizer, HybridSummarizer):
+        print(f"Extractive fallback used for {summarizer.fallbacks} groups.")
 
     print("\n=====Embedding=====")
-    embedding = AzureOpenAIEmbeddings(
-        model = EMBEDDING_MODEL, 
-        openai_api_version = OPENAI_API_VERSION, 
-        azure_endpoint = OPENAI_API_ENDPOINT, 
-        api_key = OPENAI_API_KEY)
-
-    embedd_chunks(PERSIST_DIRECTORY, chunks_map, embedding)
+    embedd_chunks(PERSIST_DIRECTORY, chunks_map, embedding, book_id=book_id)
+    save_indexes(PERSIST_DIRECTORY, chunks_map, embedding, source=file_path, book_id=book_id)
+    write_index_manifest(INDEX_MANIFEST_PATH, source=file_path, embedding_model=model_id, library=book_id is not None)
+    print(f"Embedding cache: {embedding.hits} hits, {embedding.misses} texts embedded.")
 
     print("Embedded succesfully")
     
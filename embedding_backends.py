@@ -0,0 +1,66 @@
+import os
+import json
+
+from config import OPENAI_API_VERSION, OPENAI_API_KEY, OPENAI_API_ENDPOINT
+from config import EMBEDDING_MODEL, EMBEDDING_BACKEND, LOCAL_EMBEDDING_CONFIG
+
+# Indexes built before the manifest recorded a model were all embedded with Azure
+LEGACY_EMBEDDING_MODEL_ID = f"azure:{EMBEDDING_MODEL}"
+
+def embedding_model_id(backend=None):
+    backend = backend or EMBEDDING_BACKEND
+    if backend == 'azure':
+        return f"azure:{EMBEDDING_MODEL}"
+    if backend == 'local':
+        return f"local:{LOCAL_EMBEDDING_CONFIG['model_name']}"
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}', expected 'azure' or 'local'.")
+
+def build_local_embedding(config=LOCAL_EMBEDDING_CONFIG):
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    model_kwargs = {'device': 'cpu'}
+    if config['runtime'] == 'onnx':
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = config['threads']
+        model_kwargs['backend'] = 'onnx'
+        model_kwargs['model_kwargs'] = {'provider': 'CPUExecutionProvider', 'session_options': session_options}
+    elif config['runtime'] == 'torch':
+        import torch
+        torch.set_num_threads(config['threads'])
+    else:
+        raise ValueError(f"Unknown local embedding runtime '{config['runtime']}', expected 'onnx' or 'torch'.")
+
+    return HuggingFaceEmbeddings(
+        model_name=config['model_name'],
+        model_kwargs=model_kwargs,
+        encode_kwargs={'batch_size': config['batch_size'], 'normalize_embeddings': True}
+    )
+
+def build_embedding(backend=None):
+    backend = backend or EMBEDDING_BACKEND
+    if backend == 'local':
+        return build_local_embedding()
+    if backend == 'azure':
+        from langchain_openai import AzureOpenAIEmbeddings
+        return AzureOpenAIEmbeddings(model = EMBEDDING_MODEL, openai_api_version = OPENAI_API_VERSION, azure_endpoint = OPENAI_API_ENDPOINT, api_key = OPENAI_API_KEY)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}', expected 'azure' or 'local'.")
+
+def indexed_model_id(manifest_path):
+    # None when nothing was indexed yet
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('embedding_model', LEGACY_EMBEDDING_MODEL_ID)
+
+def check_index_model(manifest_path, model_id):
+    '''
+    Vectors from different models are not comparable (and usually differ in size), so querying an index with
+    another model than the one that built it would return garbage instead of failing.
+    '''
+    indexed = indexed_model_id(manifest_path)
+    if indexed is not None and indexed != model_id:
+        raise RuntimeError(
+            f"The index in {os.path.dirname(manifest_path)} was built with '{indexed}' but queries would use '{model_id}'. "
+            f"Set EMBEDDING_BACKEND / LOCAL_EMBEDDING_MODEL to match, or re-run embedding.py."
+        )
@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+from telemetry import span, record
+
+
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+def cache_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\x00{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+def content_hash(doc):
+    metadata = {key: value for key, value in doc.metadata.items() if key != 'content_hash'}
+    payload = f"{normalize_text(doc.page_content)}\x00{sorted(metadata.items())}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Persistent document-embedding cache keyed by sha256(model, normalized text).
+    Only texts that were never embedded with this model reach the underlying embedding client.
+    '''
+    def __init__(self, embedding, model_name, cache_path):
+        self.embedding = embedding
+        self.model_name = model_name
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, keys):
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+        return found
+
+    def _store(self, items):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array('f', vector).tobytes()) for key, vector in items]
+            )
+            self.connection.commit()
+
+    def embed_documents(self, texts):
+        keys = [cache_key(self.model_name, text) for text in texts]
+        vectors = self._lookup(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            with span('embed_documents', texts=len(missing)):
+                new_vectors = self.embedding.embed_documents(list(missing.values()))
+            self._store(zip(missing.keys(), new_vectors))
+            vectors.update(zip(missing.keys(), new_vectors))
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embedding.embed_query(text)
+
+
+class QueryEmbeddingCache(Embeddings):
+    '''
+    Process-wide LRU cache for query embeddings, bounded by size and TTL.
+    The same keyword searched at several levels, or again later in the turn, is embedded only once.
+    '''
+    def __init__(self, embedding, max_size=1024, ttl_seconds=3600):
+        self.embedding = embedding
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def _store(self, key, vector):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), vector)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def embed_query(self, text):
+        key = normalize_text(text)
+        vector = self._lookup(key)
+        record('query_embeddings', labels={'cache': 'miss' if vector is None else 'hit'})
+        if vector is None:
+            with span('embed_query'):
+                vector = self.embedding.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        key = normalize_text(text)
+        vector = self._lookup(key)
+        record('query_embeddings', labels={'cache': 'miss' if vector is None else 'hit'})
+        if vector is None:
+            with span('embed_query'):
+                vector = await self.embedding.aembed_query(text)
+            self._store(key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embedding.embed_documents(texts)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
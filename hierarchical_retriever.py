@@ -1,65 +1,266 @@
 import ast
+import asyncio
+
+from telemetry import span, size_bucket
+
+BEAM_CONFIG = {
+    # Nodes kept per level while descending
+    'beam_width' : {5: 3, 4: 4, 3: 5, 2: 6},
+    # Hits scoring below best * relative_threshold are pruned
+    'relative_threshold' : 0.85,
+    # When the best hit leads the runner-up by this margin its branch is followed alone, straight down to the target level
+    'dominance_margin' : 0.08
+}
+
+def distance_to_similarity(distance):
+    # Both backends score in Chroma's default l2 space; on unit vectors squared l2 = 2 - 2 * cosine
+    return 1.0 - distance / 2.0
+
+def chunk_filter(filter_indices=None, books=None):
+    '''
+    filter_indices is a list of chunk_index, or {book_id: [chunk_index]} with book_id None for a single-book index.
+    books restricts the search to some books of a library: chunk_index restarts at 0 in every book, so a plain list
+    is only meaningful together with them.
+    '''
+    if isinstance(filter_indices, dict):
+        clauses = [
+            {"chunk_index": {"$in": list(indices)}} if book_id is None else
+            {"$and": [{"book_id": book_id}, {"chunk_index": {"$in": list(indices)}}]}
+            for book_id, indices in filter_indices.items() if indices
+        ]
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+    if filter_indices:
+        if books:
+            return {"$and": [{"book_id": {"$in": list(books)}}, {"chunk_index": {"$in": list(filter_indices)}}]}
+        return {"chunk_index": {"$in": list(filter_indices)}}
+    if books:
+        return {"book_id": {"$in": list(books)}}
+    return None
+
+def filter_size(filter_indices):
+    if isinstance(filter_indices, dict):
+        return sum(len(indices) for indices in filter_indices.values())
+    return len(filter_indices) if filter_indices else 0
 
 class SingleRetriever():
-    def __init__(self, vector_store, top_k, level_name, filter_indices = None):
+    def __init__(self, vector_store, top_k, level_name):
         self.vector_store = vector_store
         self.top_k = top_k
         self.level_name = level_name
-        self.filter_indices = filter_indices
-    
-    def get_indices(self):
-        return self.filter_indices
-    
-    def update_indices(self, indices):
-        if isinstance(indices, str):
-            indices = ast.literal_eval(indices)
-        if isinstance(indices, list):
-            self.filter_indices = indices
-        else:
-            raise ValueError("filter_indices must be a list.")
-        
-    def remove_indices(self):
-        self.filter_indices = None
-
-    def retrieve_documents(self, query):
-        if self.filter_indices:
-            response = self.vector_store.similarity_search(
-                query=query,
-                k=self.top_k,
-                filter={"chunk_index": {"$in": self.filter_indices}}
-            )
-        else:
-            response = self.vector_store.similarity_search(
-                query=query,
-                k=self.top_k
-            )
-        return response
+
+    def search_kwargs(self, filter_indices=None, books=None):
+        search_kwargs = {"k": self.top_k}
+        filter = chunk_filter(filter_indices, books)
+        if filter:
+            search_kwargs["filter"] = filter
+        return search_kwargs
+
+    def search_span(self, filter_indices):
+        size = filter_size(filter_indices)
+        return span('retrieve_documents', labels={'level': self.level_name, 'filter_size': size_bucket(size)}, filter_size=size)
+
+    def retrieve_documents(self, query, query_vector=None, filter_indices=None, books=None):
+        search_kwargs = self.search_kwargs(filter_indices, books)
+        with self.search_span(filter_indices):
+            if query_vector is not None:
+                return self.vector_store.similarity_search_by_vector(query_vector, **search_kwargs)
+            return self.vector_store.similarity_search(query=query, **search_kwargs)
+
+    def retrieve_with_scores(self, query_vector, filter_indices=None, books=None):
+        with self.search_span(filter_indices):
+            results = self.vector_store.similarity_search_by_vector_with_relevance_scores(query_vector, **self.search_kwargs(filter_indices, books))
+        return [(doc, distance_to_similarity(distance)) for doc, distance in results]
+
+    async def aretrieve_with_scores(self, query_vector, filter_indices=None, books=None):
+        return await asyncio.to_thread(self.retrieve_with_scores, query_vector, filter_indices, books)
+
+    async def aretrieve_documents(self, query, query_vector=None, filter_indices=None, books=None):
+        search_kwargs = self.search_kwargs(filter_indices, books)
+        with self.search_span(filter_indices):
+            if query_vector is not None:
+                return await self.vector_store.asimilarity_search_by_vector(query_vector, **search_kwargs)
+            return await self.vector_store.asimilarity_search(query=query, **search_kwargs)
 
 class HierarchicalRetriever:
-    def __init__(self, single_retrievers):
+    '''
+    Stateless: filters, query vectors and levels are passed per call, so one instance can serve many sessions concurrently.
+    With a library, every search is first routed to the most relevant books and the descent stays inside them.
+    '''
+    def __init__(self, single_retrievers, embedding=None, tree=None, library=None, prefetcher=None):
         self.retrievers_map = {
             retriever.level_name: retriever for retriever in single_retrievers
         }
+        self.embedding = embedding
+        self.tree = tree
+        self.library = library
+        self.prefetcher = prefetcher
+
+    def tree_for(self, book_id):
+        return self.tree if book_id is None else self.library.tree(book_id)
+
+    def route(self, query_vector):
+        # [(book_id, score)] of the routed books, None for a single-book index
+        if self.library is None:
+            return None
+        with span('route_books', books=len(self.library)):
+            return self.library.route(query_vector)
+
+    def route_step(self, routed, trace):
+        # Returns the book ids searches are restricted to, and notes them in the trace
+        if routed is None:
+            return None
+        trace.append({'books': routed})
+        return [book_id for book_id, _ in routed]
 
     def get_retriever(self, level):
         if level not in self.retrievers_map:
             raise KeyError(f"{level} not found in retrievers.")
         return self.retrievers_map[level]
 
-    def update_indices(self, level, indices):
-        self.get_retriever(level).update_indices(indices)
+    def embed_query(self, query):
+        if self.embedding is None:
+            return None
+        return self.embedding.embed_query(query)
+
+    async def aembed_query(self, query):
+        if self.embedding is None:
+            return None
+        return await self.embedding.aembed_query(query)
+
+    @staticmethod
+    def parse_indices(indices):
+        # A list of chunk_index, or {book_id: [chunk_index]} in a library
+        if isinstance(indices, str):
+            indices = ast.literal_eval(indices)
+        if isinstance(indices, dict):
+            return {book_id: list(book_indices) for book_id, book_indices in indices.items() if book_indices} or None
+        if indices is not None and not isinstance(indices, (list, tuple)):
+            raise ValueError("indices must be a list or a {book_id: list} dict.")
+        return list(indices) if indices else None
+
+    def level_books(self, query_vector, indices, book, trace):
+        # Books a retrieve_by_level search is restricted to: the one named, none when indices name their books, else the routed ones
+        if self.library is None or isinstance(indices, dict):
+            return None
+        if book is not None:
+            return [book]
+        return self.route_step(self.route(query_vector), trace)
+
+    def schedule_prefetch(self, level, docs):
+        # Only the hits the beam would keep from this level are expanded
+        if self.prefetcher is not None:
+            self.prefetcher.schedule(level, docs[:BEAM_CONFIG['beam_width'].get(level, len(docs))], self.tree_for)
+
+    def search_level(self, level, query_vector, candidates=None, books=None):
+        retriever = self.get_retriever(f"level_{level}")
+        if self.prefetcher is not None and candidates:
+            hits = self.prefetcher.search(level, query_vector, candidates, retriever.top_k)
+            if hits is not None:
+                return hits
+        return retriever.retrieve_with_scores(query_vector, filter_indices=candidates, books=books)
+
+    async def asearch_level(self, level, query_vector, candidates=None, books=None):
+        retriever = self.get_retriever(f"level_{level}")
+        if self.prefetcher is not None and candidates:
+            hits = self.prefetcher.search(level, query_vector, candidates, retriever.top_k)
+            if hits is not None:
+                return hits
+        return await retriever.aretrieve_with_scores(query_vector, filter_indices=candidates, books=books)
+
+    def retrieve_by_level(self, query, level, indices = None, query_vector = None, book = None):
+        if query_vector is None:
+            query_vector = self.embed_query(query)
+        indices = self.parse_indices(indices)
+        books = self.level_books(query_vector, indices, book, [])
+        docs = self.get_retriever(level).retrieve_documents(query, query_vector=query_vector, filter_indices=indices, books=books)
+        self.schedule_prefetch(int(level.split('_')[1]), docs)
+        return docs
+
+    async def aretrieve_by_level(self, query, level, indices = None, query_vector = None, book = None):
+        if query_vector is None:
+            query_vector = await self.aembed_query(query)
+        indices = self.parse_indices(indices)
+        books = self.level_books(query_vector, indices, book, [])
+        docs = await self.get_retriever(level).aretrieve_documents(query, query_vector=query_vector, filter_indices=indices, books=books)
+        self.schedule_prefetch(int(level.split('_')[1]), docs)
+        return docs
+
+    def beam_step(self, level, hits, low_level, trace):
+        # Prunes the hits of one level and returns (next level, {book_id: candidate indices there})
+        best = hits[0][1]
+        cutoff = best - abs(best) * (1.0 - BEAM_CONFIG['relative_threshold'])
+        kept = [hit for hit in hits if hit[1] >= cutoff]
+        kept = kept[:BEAM_CONFIG['beam_width'].get(level, len(kept))]
+        dominant = len(hits) == 1 or best - hits[1][1] >= BEAM_CONFIG['dominance_margin']
+        if dominant:
+            kept = kept[:1]
+        trace.append({'level': level, 'best': best, 'kept': len(kept), 'hits': len(hits), 'dominant': dominant})
+
+        groups = {}
+        for doc, _ in kept:
+            groups.setdefault(doc.metadata.get('book_id'), []).append(doc.metadata['chunk_index'])
+        next_level = low_level if dominant else level - 1
+        candidates = {}
+        for book_id, indices in groups.items():
+            descendants = self.tree_for(book_id).descendants(level, indices, next_level)
+            if descendants:
+                candidates[book_id] = descendants
+        return next_level, candidates
+
+    def descend(self, query, high_level, low_level, query_vector = None):
+        '''
+        Beam search from high_level down to low_level. Returns the scored low_level hits and a per-level trace of
+        best score, beam size and whether one branch dominated (which ends the descent early).
+        '''
+        if query_vector is None:
+            query_vector = self.embed_query(query)
+
+        trace = []
+        books = self.route_step(self.route(query_vector), trace)
+        level, candidates = high_level, None
+        while level > low_level:
+            hits = self.search_level(level, query_vector, candidates, books)
+            if not hits:
+                # Nothing under the beam kept so far: say so rather than widening to an unfiltered search
+                trace.append({'level': level, 'best': None, 'kept': 0, 'hits': 0, 'dominant': False})
+                return [], trace
+            level, candidates = self.beam_step(level, hits, low_level, trace)
+            if not candidates:
+                return [], trace
+
+        hits = self.search_level(low_level, query_vector, candidates, books)
+        trace.append({'level': low_level, 'best': hits[0][1] if hits else None, 'kept': len(hits), 'hits': len(hits), 'dominant': False})
+        self.schedule_prefetch(low_level, [doc for doc, _ in hits])
+        return hits, trace
+
+    async def adescend(self, query, high_level, low_level, query_vector = None):
+        if query_vector is None:
+            query_vector = await self.aembed_query(query)
 
+        trace = []
+        books = self.route_step(self.route(query_vector), trace)
+        level, candidates = high_level, None
+        while level > low_level:
+            hits = await self.asearch_level(level, query_vector, candidates, books)
+            if not hits:
+                # Nothing under the beam kept so far: say so rather than widening to an unfiltered search
+                trace.append({'level': level, 'best': None, 'kept': 0, 'hits': 0, 'dominant': False})
+                return [], trace
+            level, candidates = self.beam_step(level, hits, low_level, trace)
+            if not candidates:
+                return [], trace
 
-    def remove_indices(self, level):
-        self.get_retriever(level).remove_indices()
+        hits = await self.asearch_level(low_level, query_vector, candidates, books)
+        trace.append({'level': low_level, 'best': hits[0][1] if hits else None, 'kept': len(hits), 'hits': len(hits), 'dominant': False})
+        self.schedule_prefetch(low_level, [doc for doc, _ in hits])
+        return hits, trace
 
-    def get_indices(self, level):
-        return self.get_retriever(level).get_indices()
+    def retrieve_across_level(self, query, high_level, low_level, query_vector = None):
+        hits, _ = self.descend(query, high_level, low_level, query_vector=query_vector)
+        return [doc for doc, _ in hits]
 
-    def retrieve_by_level(self, query, level, indices = None):
-        if indices and len(indices) > 0:
-            self.update_indices(level, indices=indices)
-        
-        results = self.get_retriever(level).retrieve_documents(query)
-        self.remove_indices(level)
-        return results
\ No newline at end of file
+    async def aretrieve_across_level(self, query, high_level, low_level, query_vector = None):
+        hits, _ = await self.adescend(query, high_level, low_level, query_vector=query_vector)
+        return [doc for doc, _ in hits]
@@ -0,0 +1,227 @@
+import re
+import ast
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from langchain.docstore.document import Document
+
+from utils import SUMMARIZER_CONFIG, summary_rate_limiter, log_summary_error
+from tokens import count_tokens
+from summarizers import LLMSummarizer
+
+# A chapter heading or a scene break. clean_text joins a page into one line, so a heading inside a chunk follows the end
+# of a sentence rather than a line break; chapter / volume need a number after them to tell them from prose
+SECTION_START = re.compile(
+    r'(?:^|(?<=[.!?"\')] ))[ \t]*(?:(?:volume|chapter)\s+(?:\d+|[ivxlc]+\b)|(?:prologue|epilogue|interlude|intermission|afterword)\b)'
+    r'|(?:[*#~][ \t]*){3,}',
+    re.I | re.M
+)
+
+def starts_section(text):
+    # A level-1 chunk starts a section when a heading sits in its first half: a heading near the end belongs to the
+    # next chunk, which repeats it in the overlap, and the chunk itself is mostly the previous section
+    match = SECTION_START.search(text)
+    return match is not None and match.start() < len(text) / 2
+
+
+class LevelState:
+    def __init__(self, level, grouping):
+        self.level = level
+        self.grouping = grouping
+        self.chunks = []
+        # boundaries[i]: chunk i opens a chapter / scene (at level > 1: its first child does)
+        self.boundaries = []
+        self.tokens = []
+        self.results = {}
+        self.groups = {}
+        self.next_start = 0
+        self.submitted = 0
+        self.committed = 0
+        self.done = False
+
+    def token_count(self, position):
+        while len(self.tokens) <= position:
+            self.tokens.append(count_tokens(self.chunks[len(self.tokens)].page_content))
+        return self.tokens[position]
+
+
+class FixedGrouping:
+    '''
+    size children per parent in order, the last group takes what is left.
+    '''
+    def __init__(self, size):
+        self.size = size
+
+    def group_end(self, child, start):
+        # End position of the group starting at start, None until enough children are known to decide
+        available = len(child.chunks)
+        if available >= start + self.size:
+            return start + self.size
+        if child.done and available > start:
+            return available
+        return None
+
+
+class TokenBudgetGrouping:
+    '''
+    Packs consecutive children until the next one would push the group past target_tokens (tiktoken count),
+    and closes a group before a child that opens a chapter or scene when the group holds part of a section, so a summary
+    does not straddle one. Higher up, where children are whole chapters, those are packed together by the budget alone.
+    Neither closes a group below min_children: a short chapter tail goes with the start of the next one rather than
+    costing a summarizer call of its own.
+    '''
+    def __init__(self, target_tokens, min_children=2, max_children=12):
+        self.target_tokens = target_tokens
+        self.min_children = min_children
+        self.max_children = max_children
+
+    def group_end(self, child, start):
+        tokens = 0
+        partial = False
+        for position in range(start, len(child.chunks)):
+            size = position - start
+            if size >= self.max_children:
+                return position
+            if size >= self.min_children and (partial and child.boundaries[position] or tokens + child.token_count(position) > self.target_tokens):
+                return position
+            tokens += child.token_count(position)
+            partial = partial or not child.boundaries[position]
+        if child.done and len(child.chunks) > start:
+            return len(child.chunks)
+        return None
+
+
+class PipelinedHierarchyBuilder:
+    '''
+    Builds every summary level at once instead of level by level.
+    A level-N group is scheduled as soon as its window of level N-1 chunks has been committed,
+    and chunks are committed strictly in group order so chunk_index / group_index match the sequential build.
+    groupings (optional) maps a level to how its children are grouped, HIERARCHICAL_CONFIG's fixed sizes by default.
+    '''
+    def __init__(self, hierarchical_config, max_workers=None, rate_limiter=None, on_node=None, on_level=None, log_error=True, summarizer=None, groupings=None):
+        self.groupings = {
+            int(key.split('_')[1]): FixedGrouping(n_content_chunks) for key, n_content_chunks in hierarchical_config.items()
+        }
+        self.groupings.update(groupings or {})
+        self.max_workers = max_workers or SUMMARIZER_CONFIG['max_workers']
+        self.rate_limiter = rate_limiter or summary_rate_limiter
+        self.summarizer = summarizer or LLMSummarizer(self.rate_limiter)
+        self.on_node = on_node
+        self.on_level = on_level
+        self.log_error = log_error
+
+    def build(self, chunks_map, level_1_stream=None):
+        '''
+        level_1_stream (optional) yields level-1 chunks in chunk_index order when there is no level-1 backup,
+        summaries of its first windows start while the rest of the book is still being read.
+        '''
+        top_level = max(self.groupings)
+        self.states = {1: LevelState(1, None)}
+        for level in range(2, top_level + 1):
+            self.states[level] = LevelState(level, self.groupings[level])
+
+        # Levels restored from backup are committed up front, the first missing level and everything above it is rebuilt
+        for level in range(1, top_level + 1):
+            if f"level_{level}" not in chunks_map:
+                break
+            state = self.states[level]
+            for doc in chunks_map[f"level_{level}"]:
+                self._emit(state, doc)
+            state.done = True
+
+        self.ready = []
+        self.pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            if not self.states[1].done and level_1_stream is not None:
+                for doc in level_1_stream:
+                    self._emit(self.states[1], doc)
+                    self._collect(wait(self.pending, timeout=0)[0])
+                    self._advance(executor)
+                self._finish(self.states[1])
+
+            self._advance(executor)
+            while self.pending:
+                finished, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                self._collect(finished)
+                self._advance(executor)
+
+        return {f"level_{level}": state.chunks for level, state in self.states.items()}
+
+    def _collect(self, finished):
+        for future in finished:
+            level, group_number = self.pending.pop(future)
+            try:
+                self.states[level].results[group_number] = future.result()
+            except Exception as e:
+                if self.log_error:
+                    log_summary_error(group_number, e)
+                self.states[level].results[group_number] = None
+
+    def _finish(self, state):
+        state.done = True
+        print(f"Completed chunking at level {state.level} with a total {len(state.chunks)} chunks.\n")
+        if self.on_level is not None:
+            self.on_level(state.level, state.chunks)
+
+    def _starts_section(self, state, doc):
+        if state.level == 1:
+            return starts_section(doc.page_content)
+        children = doc.metadata.get('group_index') or []
+        if isinstance(children, str):
+            children = ast.literal_eval(children)
+        boundaries = self.states[state.level - 1].boundaries
+        return bool(children) and 0 <= int(children[0]) < len(boundaries) and boundaries[int(children[0])]
+
+    def _emit(self, state, doc):
+        state.boundaries.append(self._starts_section(state, doc))
+        state.chunks.append(doc)
+        if self.on_node is not None:
+            self.on_node(state.level, doc)
+
+    def _advance(self, executor):
+        # Level 1 is only ever fed (from backup or the stream), nothing to schedule there
+        for level in sorted(self.states)[1:]:
+            state = self.states[level]
+            if state.done:
+                continue
+            self._commit(state)
+            self._schedule(state)
+            child = self.states[level - 1]
+            if child.done and state.committed == state.submitted and state.next_start >= len(child.chunks):
+                self._finish(state)
+
+        # Higher levels go first: they sit on the critical path, the remaining low-level groups do not
+        while self.ready and len(self.pending) < self.max_workers:
+            _, group_number, level, group = heapq.heappop(self.ready)
+            future = executor.submit(self.summarizer.summarize, group)
+            self.pending[future] = (level, group_number)
+
+    def _schedule(self, state):
+        child = self.states[state.level - 1]
+        while True:
+            end = state.grouping.group_end(child, state.next_start)
+            if end is None:
+                break
+            group = child.chunks[state.next_start : end]
+            state.groups[state.submitted] = group
+            heapq.heappush(self.ready, (-state.level, state.submitted, state.level, group))
+            state.submitted += 1
+            state.next_start = end
+
+    def _commit(self, state):
+        while state.committed in state.results:
+            summary = state.results.pop(state.committed)
+            group = state.groups.pop(state.committed)
+            state.committed += 1
+            if summary is None:
+                continue
+            # The children's own chunk_index values: exact at the tail and whatever the grouping
+            doc = Document(
+                page_content=summary,
+                metadata={
+                    "level": state.level,
+                    "group_index": [int(child.metadata['chunk_index']) for child in group],
+                    "chunk_index": len(state.chunks)
+                }
+            )
+            self._emit(state, doc)
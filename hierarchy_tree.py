@@ -0,0 +1,112 @@
+import os
+import ast
+
+import numpy as np
+
+def node_id(level, chunk_index, book_id=None):
+    # Store id of a chunk, level is 'level_<n>'. chunk_index restarts at 0 in every library book, so those ids carry the book
+    if book_id is not None:
+        return f"{book_id}/{level}:{chunk_index}"
+    return f"{level}:{chunk_index}"
+
+class HierarchyTree:
+    '''
+    Array-backed parent/child structure of the chunk hierarchy, built once at index time.
+    Children of node i at level L are child_indices[L][child_offsets[L][i] : child_offsets[L][i + 1]] (chunk_index values at level L-1),
+    and parents[L][i] is the chunk_index of its level L+1 parent (-1 at the top level or for orphans).
+    '''
+    def __init__(self, levels, parents, child_offsets, child_indices):
+        self.levels = sorted(levels)
+        self.parents = parents
+        self.child_offsets = child_offsets
+        self.child_indices = child_indices
+
+    @classmethod
+    def from_metadatas(cls, metadatas_map):
+        levels = sorted(int(level.split('_')[1]) for level in metadatas_map)
+        sizes = {}
+        for level in levels:
+            indices = [int(metadata['chunk_index']) for metadata in metadatas_map[f"level_{level}"]]
+            sizes[level] = max(indices) + 1 if indices else 0
+
+        parents = {level: np.full(sizes[level], -1, dtype=np.int64) for level in levels}
+        child_offsets = {}
+        child_indices = {}
+        for level in levels[1:]:
+            groups = [[] for _ in range(sizes[level])]
+            for metadata in metadatas_map[f"level_{level}"]:
+                group_index = metadata.get('group_index', [])
+                if isinstance(group_index, str):
+                    group_index = ast.literal_eval(group_index)
+                groups[int(metadata['chunk_index'])] = [int(child) for child in group_index if 0 <= int(child) < sizes[level - 1]]
+
+            offsets = np.zeros(sizes[level] + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(group) for group in groups])
+            child_offsets[level] = offsets
+            child_indices[level] = np.asarray([child for group in groups for child in group], dtype=np.int64)
+            for parent, group in enumerate(groups):
+                parents[level - 1][group] = parent
+
+        return cls(levels, parents, child_offsets, child_indices)
+
+    @classmethod
+    def from_chunks_map(cls, chunks_map):
+        return cls.from_metadatas({
+            level: [doc.metadata for doc in chunks] for level, chunks in chunks_map.items()
+        })
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        arrays = {'levels': np.asarray(self.levels, dtype=np.int64)}
+        for level in self.levels:
+            arrays[f"parents_{level}"] = self.parents[level]
+        for level in self.child_offsets:
+            arrays[f"child_offsets_{level}"] = self.child_offsets[level]
+            arrays[f"child_indices_{level}"] = self.child_indices[level]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            levels = [int(level) for level in data['levels']]
+            parents = {level: data[f"parents_{level}"] for level in levels}
+            child_offsets = {level: data[f"child_offsets_{level}"] for level in levels[1:]}
+            child_indices = {level: data[f"child_indices_{level}"] for level in levels[1:]}
+        return cls(levels, parents, child_offsets, child_indices)
+
+    def children(self, level, indices):
+        if level not in self.child_offsets:
+            return []
+        offsets = self.child_offsets[level]
+        result = []
+        seen = set()
+        for index in indices:
+            index = int(index)
+            if not 0 <= index < len(offsets) - 1:
+                continue
+            for child in self.child_indices[level][offsets[index] : offsets[index + 1]].tolist():
+                if child not in seen:
+                    seen.add(child)
+                    result.append(child)
+        return result
+
+    def descendants(self, level, indices, target_level):
+        while level > target_level:
+            indices = self.children(level, indices)
+            level -= 1
+        return list(indices)
+
+    def parent(self, level, index):
+        parents = self.parents.get(level)
+        if parents is None or not 0 <= index < len(parents) or parents[index] < 0:
+            return None
+        return int(parents[index])
+
+    def ancestors(self, level, index):
+        result = []
+        while True:
+            index = self.parent(level, index)
+            if index is None:
+                return result
+            level += 1
+            result.append((level, index))
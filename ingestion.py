@@ -0,0 +1,102 @@
+import os
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain.docstore.document import Document
+
+from utils import clean_text
+
+INGESTION_CONFIG = {
+    'workers' : os.cpu_count() or 1,
+    # Pages extracted per worker task, small enough to keep workers balanced, large enough to amortize pickling
+    'pages_per_task' : 16,
+    # Tasks in flight per worker: bounds how many extracted pages wait in memory for the consumer
+    'tasks_per_worker' : 2,
+    # Pages with less text than this (blank pages, lone page numbers) are skipped
+    'min_page_chars' : 20
+}
+
+def keep_page(text):
+    return len(text.strip()) > INGESTION_CONFIG['min_page_chars']
+
+@lru_cache(maxsize=4)
+def open_pdf(file_path):
+    # One reader per worker process, reused by every task it runs
+    from pypdf import PdfReader
+    return PdfReader(file_path)
+
+@lru_cache(maxsize=4)
+def page_labels(file_path):
+    # reader.page_labels rebuilds the labels of the whole document on every access, so each worker builds them once
+    return open_pdf(file_path).page_labels
+
+def extract_pages(file_path, start, end):
+    reader = open_pdf(file_path)
+    labels = page_labels(file_path)
+    pages = []
+    for i in range(start, end):
+        text = reader.pages[i].extract_text() or ''
+        if keep_page(text):
+            pages.append((i, labels[i] if i < len(labels) else str(i + 1), clean_text(text)))
+    return pages
+
+def stream_pdf_pages(file_path, workers=None):
+    workers = workers or INGESTION_CONFIG['workers']
+    total_pages = len(open_pdf(file_path).pages)
+    step = INGESTION_CONFIG['pages_per_task']
+    ranges = iter([(start, min(start + step, total_pages)) for start in range(0, total_pages, step)])
+    max_pending = workers * INGESTION_CONFIG['tasks_per_worker']
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in ranges:
+            pending.append(executor.submit(extract_pages, file_path, start, end))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            # Results are consumed in submission order, so pages come out in document order whatever finishes first
+            pages = pending.popleft().result()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                pending.append(executor.submit(extract_pages, file_path, *next_range))
+            for page, page_label, text in pages:
+                yield Document(
+                    page_content=text,
+                    metadata={'source': file_path, 'total_pages': total_pages, 'page': page, 'page_label': page_label}
+                )
+
+def stream_documents(file_path, workers=None):
+    '''
+    Cleaned pages as a generator. PDFs are extracted and cleaned by a pool of worker processes with a bounded
+    number of tasks in flight, other formats go through the loader's lazy_load.
+    '''
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File path does not exist: {file_path}")
+
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".pdf":
+        yield from stream_pdf_pages(file_path, workers)
+        return
+
+    from langchain_community.document_loaders import UnstructuredWordDocumentLoader, TextLoader
+    if ext == ".txt":
+        loader = TextLoader(file_path)
+    elif ext in [".doc", ".docx"]:
+        loader = UnstructuredWordDocumentLoader(file_path)
+    else:
+        raise ValueError(f"Unsupported file type: {ext}. Only .pdf, .txt, and .doc/.docx are supported.")
+
+    for doc in loader.lazy_load():
+        if keep_page(doc.page_content):
+            doc.page_content = clean_text(doc.page_content)
+            yield doc
+
+def stream_chunks(pages, splitter):
+    # split_documents splits every page on its own, so splitting page by page gives the same chunks in the same order
+    chunk_index = 0
+    for page in pages:
+        for chunk in splitter.split_documents([page]):
+            chunk.metadata['chunk_index'] = chunk_index
+            chunk_index += 1
+            yield chunk
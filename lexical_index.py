@@ -0,0 +1,171 @@
+import os
+import re
+
+import numpy as np
+
+from langchain.docstore.document import Document
+
+LEXICAL_CONFIG = {
+    'k1' : 1.5,
+    'b' : 0.75,
+    # Reciprocal rank fusion constant, 60 is the usual choice
+    'rrf_k' : 60
+}
+
+WORD = re.compile(r"[a-z0-9]+(?:'[a-z0-9]+)*")
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+def pack_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(data) for data in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def unpack_string(blob, offsets, i):
+    return blob[offsets[i] : offsets[i + 1]].tobytes().decode('utf-8')
+
+
+class LexicalIndex:
+    '''
+    Positional inverted index over level-1 chunks, stored as flat arrays (CSR style like HierarchyTree):
+    postings of term t are rows posting_rows[term_offsets[t] : term_offsets[t + 1]] with their term frequencies,
+    and the token positions of posting p are positions[position_offsets[p] : position_offsets[p + 1]].
+    Chunk texts are kept too, so a lookup needs neither the vector store nor an embedding call.
+    '''
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.term_offsets = arrays['term_offsets']
+        self.posting_rows = arrays['posting_rows']
+        self.posting_tf = arrays['posting_tf']
+        self.position_offsets = arrays['position_offsets']
+        self.positions = arrays['positions']
+        self.doc_lengths = arrays['doc_lengths']
+        self.chunk_indices = arrays['chunk_indices']
+        self.pages = arrays['pages']
+        self.average_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+        # Every occurrence as (row << 32) + position, sorted within each term: a phrase is an intersection of shifted arrays
+        counts = np.diff(self.position_offsets)
+        self.global_positions = (np.repeat(self.posting_rows.astype(np.int64), counts) << 32) + self.positions
+        self.term_ids = {
+            unpack_string(arrays['terms'], arrays['term_string_offsets'], i): i for i in range(len(self.term_offsets) - 1)
+        }
+
+    @classmethod
+    def from_documents(cls, docs):
+        postings = {}
+        doc_lengths = []
+        for row, doc in enumerate(docs):
+            tokens = tokenize(doc.page_content)
+            doc_lengths.append(len(tokens))
+            for position, token in enumerate(tokens):
+                postings.setdefault(token, {}).setdefault(row, []).append(position)
+
+        terms = sorted(postings)
+        term_offsets = [0]
+        posting_rows, posting_tf, position_offsets, positions = [], [], [0], []
+        for term in terms:
+            for row, term_positions in sorted(postings[term].items()):
+                posting_rows.append(row)
+                posting_tf.append(len(term_positions))
+                positions.extend(term_positions)
+                position_offsets.append(len(positions))
+            term_offsets.append(len(posting_rows))
+
+        term_blob, term_string_offsets = pack_strings(terms)
+        text_blob, text_offsets = pack_strings([doc.page_content for doc in docs])
+        return cls({
+            'term_offsets': np.asarray(term_offsets, dtype=np.int64),
+            'posting_rows': np.asarray(posting_rows, dtype=np.int32),
+            'posting_tf': np.asarray(posting_tf, dtype=np.int32),
+            'position_offsets': np.asarray(position_offsets, dtype=np.int64),
+            'positions': np.asarray(positions, dtype=np.int32),
+            'doc_lengths': np.asarray(doc_lengths, dtype=np.int32),
+            'chunk_indices': np.asarray([int(doc.metadata['chunk_index']) for doc in docs], dtype=np.int64),
+            'pages': np.asarray([int(doc.metadata.get('page', -1)) for doc in docs], dtype=np.int64),
+            'terms': term_blob,
+            'term_string_offsets': term_string_offsets,
+            'texts': text_blob,
+            'text_offsets': text_offsets
+        })
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path, **self.arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls({key: data[key] for key in data.files})
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def _postings(self, term):
+        t = self.term_ids.get(term)
+        if t is None:
+            return None
+        return slice(self.term_offsets[t], self.term_offsets[t + 1])
+
+    def bm25(self, query, k=10):
+        # Returns [(row, score)] best first
+        scores = self.bm25_scores(query)
+        hits = np.flatnonzero(scores)
+        hits = hits[np.argsort(-scores[hits], kind='stable')][:k]
+        return [(int(row), float(scores[row])) for row in hits]
+
+    def bm25_scores(self, query):
+        # BM25 score of every row, 0 for rows sharing no term with query
+        scores = np.zeros(len(self), dtype=np.float32)
+        n = len(self)
+        k1, b = LEXICAL_CONFIG['k1'], LEXICAL_CONFIG['b']
+        for term in set(tokenize(query)):
+            postings = self._postings(term)
+            if postings is None:
+                continue
+            rows = self.posting_rows[postings]
+            tf = self.posting_tf[postings].astype(np.float32)
+            idf = np.log(1.0 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = k1 * (1.0 - b + b * self.doc_lengths[rows] / max(self.average_length, 1e-9))
+            scores[rows] += idf * tf * (k1 + 1.0) / (tf + norm)
+        return scores
+
+    def phrase_search(self, phrase):
+        # Rows containing the tokens of phrase consecutively, in reading order
+        tokens = tokenize(phrase)
+        if not tokens:
+            return []
+        occurrences = []
+        for offset, token in enumerate(tokens):
+            postings = self._postings(token)
+            if postings is None:
+                return []
+            start, end = self.position_offsets[postings.start], self.position_offsets[postings.stop]
+            occurrences.append(self.global_positions[start:end] - offset)
+
+        # Intersect from the rarest term: its occurrences bound the result
+        occurrences.sort(key=len)
+        starts = occurrences[0]
+        for shifted in occurrences[1:]:
+            starts = np.intersect1d(starts, shifted, assume_unique=True)
+            if len(starts) == 0:
+                return []
+        return np.unique(starts >> 32).astype(int).tolist()
+
+    def document(self, row):
+        metadata = {'chunk_index': int(self.chunk_indices[row])}
+        if self.pages[row] >= 0:
+            metadata['page'] = int(self.pages[row])
+        return Document(page_content=unpack_string(self.arrays['texts'], self.arrays['text_offsets'], row), metadata=metadata)
+
+def reciprocal_rank_fusion(rankings, k=None):
+    '''
+    rankings: lists of chunk_index, best first. Returns chunk_index values ordered by sum of 1 / (k + rank).
+    '''
+    k = k or LEXICAL_CONFIG['rrf_k']
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_index in enumerate(ranking):
+            scores[chunk_index] = scores.get(chunk_index, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda chunk_index: -scores[chunk_index])
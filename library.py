@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from config import LIBRARY_MANIFEST_PATH, LIBRARY_ROUTING_PATH, LIBRARY_DIRECTORY
+from hierarchy_tree import HierarchyTree
+from lexical_index import LexicalIndex
+from vector_index import normalize_rows, top_k
+
+LIBRARY_CONFIG = {
+    # Books a query descends into, picked by their best matching top-level summary
+    'route_books' : 3,
+    # Books scoring below best * relative_threshold are dropped, like hits in the beam search
+    'relative_threshold' : 0.9,
+    # Per-book trees and keyword indexes kept in memory, the least recently used are dropped first
+    'cached_books' : 32
+}
+
+# Book ids end up in chunk ids, backup paths and the [L<level> #<chunk_index> <book_id>] tags shown to the LLM
+BOOK_ID = re.compile(r'[A-Za-z0-9][\w.-]*')
+
+def check_book_id(book_id):
+    if not BOOK_ID.fullmatch(book_id):
+        raise ValueError(f"Invalid book id '{book_id}': use letters, digits, '.', '_' or '-'.")
+    return book_id
+
+def book_directory(book_id):
+    return f"{LIBRARY_DIRECTORY}/{book_id}"
+
+def book_tree_path(book_id):
+    return f"{book_directory(book_id)}/hierarchy_tree.npz"
+
+def book_lexical_index_path(book_id):
+    return f"{book_directory(book_id)}/lexical_index.npz"
+
+def read_library_manifest(path=LIBRARY_MANIFEST_PATH):
+    if not os.path.exists(path):
+        return {'books': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_library_manifest(manifest, path=LIBRARY_MANIFEST_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def load_routing(path=LIBRARY_ROUTING_PATH):
+    # One row per top-level summary: row_books[i] is the book owning vectors[i]
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=str), np.zeros((0, 0), dtype=np.float32)
+    with np.load(path) as data:
+        return data['row_books'], data['vectors']
+
+def register_book(book_id, summary_vectors, manifest_path=LIBRARY_MANIFEST_PATH, routing_path=LIBRARY_ROUTING_PATH, **fields):
+    '''
+    Adds or replaces a book: its entry in the library manifest and its rows (top-level summary vectors) in the routing matrix.
+    '''
+    summary_vectors = np.asarray(summary_vectors, dtype=np.float32)
+    if summary_vectors.ndim != 2 or not len(summary_vectors):
+        raise ValueError(f"Book '{book_id}' has no top-level summary vectors to route queries with.")
+    summary_vectors = normalize_rows(summary_vectors)
+    row_books, vectors = load_routing(routing_path)
+    keep = row_books != book_id
+    if len(vectors) and vectors.shape[1] != summary_vectors.shape[1]:
+        raise ValueError(f"Book '{book_id}' has {summary_vectors.shape[1]}-d vectors but the library has {vectors.shape[1]}-d ones.")
+    row_books = np.concatenate([row_books[keep], np.full(len(summary_vectors), book_id)])
+    vectors = np.concatenate([vectors[keep], summary_vectors]) if len(vectors) else summary_vectors
+    os.makedirs(os.path.dirname(routing_path) or '.', exist_ok=True)
+    np.savez(routing_path, row_books=row_books, vectors=vectors)
+
+    manifest = read_library_manifest(manifest_path)
+    manifest['books'][book_id] = {'indexed_at': time.strftime('%Y-%m-%dT%H:%M:%S'), **fields}
+    write_library_manifest(manifest, manifest_path)
+
+def reset_library(manifest_path=LIBRARY_MANIFEST_PATH, routing_path=LIBRARY_ROUTING_PATH):
+    for path in (manifest_path, routing_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Library:
+    '''
+    Books indexed in library mode. Queries are routed by the best cosine similarity between the query and each book's
+    top-level summaries (a few rows per book, so routing stays one small matmul for hundreds of volumes),
+    then the descent runs inside the routed books only. Trees and keyword indexes are per book and loaded on demand.
+    '''
+    def __init__(self, manifest_path=LIBRARY_MANIFEST_PATH, routing_path=LIBRARY_ROUTING_PATH, config=None):
+        self.config = config or LIBRARY_CONFIG
+        self.books = read_library_manifest(manifest_path)['books']
+        row_books, vectors = load_routing(routing_path)
+        self.book_ids, self.owners = np.unique(row_books, return_inverse=True)
+        self.vectors = normalize_rows(vectors.astype(np.float32)) if len(vectors) else vectors
+        self.tree = lru_cache(maxsize=self.config['cached_books'])(self.load_tree)
+        self.lexical_index = lru_cache(maxsize=self.config['cached_books'])(self.load_lexical_index)
+
+    def __len__(self):
+        return len(self.books)
+
+    def route(self, query_vector):
+        # [(book_id, score)] best first
+        if query_vector is None or not len(self.vectors):
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        scores = self.vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        best = np.full(len(self.book_ids), -np.inf, dtype=np.float32)
+        np.maximum.at(best, self.owners, scores)
+
+        order = top_k(best, self.config['route_books'])
+        cutoff = best[order[0]] - abs(best[order[0]]) * (1.0 - self.config['relative_threshold'])
+        return [(str(self.book_ids[i]), float(best[i])) for i in order if best[i] >= cutoff]
+
+    def load_tree(self, book_id):
+        return HierarchyTree.load(book_tree_path(book_id))
+
+    def load_lexical_index(self, book_id):
+        path = book_lexical_index_path(book_id)
+        return LexicalIndex.load(path) if os.path.exists(path) else None
@@ -0,0 +1,144 @@
+import os
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from langchain.docstore.document import Document
+
+from hierarchy_tree import node_id
+from vector_index import normalize_rows, top_k
+import telemetry
+
+PREFETCH_CONFIG = {
+    'enabled' : os.environ.get('LINA_PREFETCH', '1') != '0',
+    # Levels below a hit whose chunks are prefetched (2: children and grandchildren)
+    'depth' : 2,
+    'max_entries_per_session' : 512,
+    'max_sessions' : 16,
+    'workers' : 2
+}
+
+# Set by the app per chat session; tool calls copy the context, so searches and the prefetches they trigger share it
+current_session = contextvars.ContextVar('current_session', default='default')
+
+prefetch_metrics = {
+    'prefetches' : 0,
+    'prefetched' : 0,
+    'hits' : 0,
+    'misses' : 0,
+    # Prefetched chunks later read by a search, and those evicted without ever being read
+    'used' : 0,
+    'wasted' : 0
+}
+
+
+class Prefetcher:
+    '''
+    Speculative prefetch for the Chroma backend. After a search at level N returns, the subtrees under the hits the beam
+    would keep (documents and stored vectors, fetched by id, no vector search) are loaded in the background into a
+    bounded per-session cache keyed by (book_id, level, chunk_index). A later filtered search whose candidates are all
+    cached, typically the follow-up retrieve_across_level / cite_from_documents on the same region, is then scored
+    locally instead of waiting for the store.
+    '''
+    def __init__(self, stores, config=None):
+        # stores: level number -> Chroma store
+        self.stores = stores
+        self.config = config or PREFETCH_CONFIG
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.config['workers'], thread_name_prefix='prefetch')
+
+    def schedule(self, level, docs, tree_for):
+        '''
+        docs: the hits of a search at level, best first. tree_for(book_id) gives the hierarchy of a book.
+        '''
+        if level <= 1 or not docs:
+            return None
+        groups = {}
+        for doc in docs:
+            groups.setdefault(doc.metadata.get('book_id'), []).append(int(doc.metadata['chunk_index']))
+        return self.executor.submit(self.prefetch, current_session.get(), level, groups, tree_for)
+
+    def prefetch(self, session, level, groups, tree_for):
+        try:
+            with telemetry.span('prefetch', level=level):
+                for target in range(level - 1, max(level - self.config['depth'], 1) - 1, -1):
+                    keys = [
+                        (book_id, target, child) for book_id, indices in groups.items()
+                        for child in tree_for(book_id).descendants(level, indices, target)
+                    ]
+                    with self.lock:
+                        cache = self.sessions.get(session, {})
+                        missing = [key for key in keys if key not in cache]
+                    if missing:
+                        self.store(session, self.fetch(target, missing))
+        except Exception as e:
+            # Speculative work: a failure only means the follow-up search goes to the store
+            print(f"[!] Prefetch failed: {e}")
+
+    def fetch(self, level, keys):
+        data = self.stores[level].get(
+            ids=[node_id(f"level_{level}", chunk_index, book_id) for book_id, _, chunk_index in keys],
+            include=['embeddings', 'documents', 'metadatas']
+        )
+        if not len(data['ids']):
+            return {}
+        vectors = normalize_rows(np.asarray(data['embeddings'], dtype=np.float32))
+        entries = {}
+        for text, metadata, vector in zip(data['documents'], data['metadatas'], vectors):
+            metadata = metadata or {}
+            key = (metadata.get('book_id'), level, int(metadata['chunk_index']))
+            entries[key] = [Document(page_content=text, metadata=metadata), vector, False]
+        return entries
+
+    def store(self, session, entries):
+        with self.lock:
+            cache = self.sessions.pop(session, None) or OrderedDict()
+            self.sessions[session] = cache
+            for key, entry in entries.items():
+                cache[key] = entry
+                cache.move_to_end(key)
+            wasted = 0
+            while len(cache) > self.config['max_entries_per_session']:
+                wasted += not cache.popitem(last=False)[1][2]
+            while len(self.sessions) > self.config['max_sessions']:
+                wasted += sum(not entry[2] for entry in self.sessions.popitem(last=False)[1].values())
+            prefetch_metrics['prefetches'] += 1
+            prefetch_metrics['prefetched'] += len(entries)
+            prefetch_metrics['wasted'] += wasted
+        telemetry.record('prefetched_chunks', len(entries))
+        if wasted:
+            telemetry.record('prefetch_wasted', wasted)
+
+    def search(self, level, query_vector, candidates, k):
+        '''
+        Scored hits [(doc, similarity)] for a filtered search when every candidate is cached for this session, else None.
+        candidates: {book_id: [chunk_index]} as built by the beam search.
+        '''
+        keys = [(book_id, level, int(index)) for book_id, indices in candidates.items() for index in indices]
+        with self.lock:
+            cache = self.sessions.get(current_session.get())
+            entries = [cache.get(key) for key in keys] if cache is not None else None
+            if not keys or entries is None or any(entry is None for entry in entries):
+                prefetch_metrics['misses'] += 1
+                entries = None
+            else:
+                prefetch_metrics['hits'] += 1
+                for key, entry in zip(keys, entries):
+                    cache.move_to_end(key)
+                    prefetch_metrics['used'] += not entry[2]
+                    entry[2] = True
+        telemetry.record('prefetch_lookups', labels={'result': 'miss' if entries is None else 'hit'})
+        if entries is None:
+            return None
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        scores = np.stack([entry[1] for entry in entries]) @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        return [(entries[i][0], float(scores[i])) for i in top_k(scores, k)]
+
+def prefetch_hit_rate():
+    lookups = prefetch_metrics['hits'] + prefetch_metrics['misses']
+    return prefetch_metrics['hits'] / lookups if lookups else None
@@ -0,0 +1,128 @@
+import re
+import threading
+
+import numpy as np
+
+from utils import summarize_group, summary_rate_limiter
+
+EXTRACTIVE_CONFIG = {
+    # Share of a group's sentences kept, clamped to [min_sentences, max_sentences]
+    'ratio' : 0.2,
+    'min_sentences' : 2,
+    'max_sentences' : 8,
+    'damping' : 0.85,
+    'iterations' : 30
+}
+
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+WORD = re.compile(r"[a-z0-9']+")
+
+def split_sentences(texts):
+    # Level-1 chunks overlap, so the same sentence can appear twice in one group
+    sentences = []
+    seen = set()
+    for text in texts:
+        for sentence in SENTENCE_SPLIT.split(text.strip()):
+            key = sentence.strip().lower()
+            if key and key not in seen:
+                seen.add(key)
+                sentences.append(sentence.strip())
+    return sentences
+
+def textrank_scores(sentences, damping=0.85, iterations=30):
+    vocabulary = {}
+    rows, cols = [], []
+    for row, sentence in enumerate(sentences):
+        for word in WORD.findall(sentence.lower()):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(word, len(vocabulary)))
+
+    n = len(sentences)
+    if not vocabulary:
+        return np.full(n, 1.0 / n)
+    tf = np.zeros((n, len(vocabulary)), dtype=np.float32)
+    np.add.at(tf, (rows, cols), 1.0)
+    idf = np.log((1 + n) / (1 + (tf > 0).sum(axis=0))) + 1.0
+    vectors = tf * idf
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    similarity = vectors @ vectors.T
+    np.fill_diagonal(similarity, 0.0)
+    totals = similarity.sum(axis=1, keepdims=True)
+    # Sentences sharing no word with any other one jump uniformly, like dangling pages in PageRank
+    transition = np.where(totals > 0, similarity / np.maximum(totals, 1e-12), 1.0 / n)
+
+    scores = np.full(n, 1.0 / n, dtype=np.float32)
+    for _ in range(iterations):
+        scores = (1 - damping) / n + damping * (transition.T @ scores)
+    return scores
+
+def extractive_summary(texts, config=EXTRACTIVE_CONFIG):
+    sentences = split_sentences(texts)
+    if not sentences:
+        return ''
+    k = int(round(len(sentences) * config['ratio']))
+    k = max(config['min_sentences'], min(config['max_sentences'], k))
+    if len(sentences) <= k:
+        return ' '.join(sentences)
+    scores = textrank_scores(sentences, config['damping'], config['iterations'])
+    keep = np.sort(np.argsort(-scores, kind='stable')[:k])
+    return ' '.join(sentences[i] for i in keep)
+
+
+class LLMSummarizer:
+    '''
+    The summarize chain from utils, behind the shared rate limiter and 429 back-off.
+    '''
+    def __init__(self, rate_limiter=None):
+        self.rate_limiter = rate_limiter or summary_rate_limiter
+
+    def summarize(self, group):
+        return summarize_group(group, self.rate_limiter)
+
+
+class ExtractiveSummarizer:
+    '''
+    Local TextRank over the group's sentences: no API calls, the kept sentences stay in reading order.
+    '''
+    def __init__(self, config=None):
+        self.config = config or EXTRACTIVE_CONFIG
+
+    def summarize(self, group):
+        return extractive_summary([doc.page_content for doc in group], self.config)
+
+
+class HybridSummarizer:
+    '''
+    Uses the LLM and falls back to an extractive summary when the call fails for good
+    (content filter, timeout, retries exhausted), so no group is dropped from the hierarchy.
+    '''
+    def __init__(self, rate_limiter=None, config=None):
+        self.llm = LLMSummarizer(rate_limiter)
+        self.extractive = ExtractiveSummarizer(config)
+        self.lock = threading.Lock()
+        self.fallbacks = 0
+
+    def summarize(self, group):
+        try:
+            summary = self.llm.summarize(group)
+            if summary and summary.strip():
+                return summary
+        except Exception as e:
+            print(f"[!] Falling back to an extractive summary: {e}")
+        with self.lock:
+            self.fallbacks += 1
+        return self.extractive.summarize(group)
+
+SUMMARIZERS = {
+    'llm' : LLMSummarizer,
+    'extractive' : ExtractiveSummarizer,
+    'hybrid' : HybridSummarizer
+}
+
+def get_summarizer_backend(name, rate_limiter=None):
+    if name not in SUMMARIZERS:
+        raise ValueError(f"Unknown summarizer '{name}', expected one of {list(SUMMARIZERS)}.")
+    if name == 'extractive':
+        return ExtractiveSummarizer()
+    return SUMMARIZERS[name](rate_limiter)
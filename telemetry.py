@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TELEMETRY_CONFIG = {
+    # JSONL file receiving one line per finished span / recorded value
+    'trace_file' : os.environ.get('LINA_TRACE_FILE'),
+    # Serves Prometheus text format on http://localhost:<port>/metrics
+    'metrics_port' : os.environ.get('LINA_METRICS_PORT'),
+    'buckets' : (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+}
+
+enabled = bool(TELEMETRY_CONFIG['trace_file'] or TELEMETRY_CONFIG['metrics_port'])
+
+NULL_SPAN = contextlib.nullcontext()
+
+lock = threading.Lock()
+histograms = {}
+counters = {}
+trace_file = None
+
+def size_bucket(n):
+    # Metric labels must stay low-cardinality, exact sizes only go to the trace file
+    if not n:
+        return '0'
+    if n <= 10:
+        return '1-10'
+    if n <= 100:
+        return '11-100'
+    return '>100'
+
+def write_event(event):
+    global trace_file
+    if not TELEMETRY_CONFIG['trace_file']:
+        return
+    line = json.dumps(event, ensure_ascii=False, default=str) + '\n'
+    with lock:
+        if trace_file is None:
+            os.makedirs(os.path.dirname(TELEMETRY_CONFIG['trace_file']) or '.', exist_ok=True)
+            trace_file = open(TELEMETRY_CONFIG['trace_file'], 'a', encoding='utf-8', buffering=1)
+        trace_file.write(line)
+
+def observe(name, seconds, labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'buckets': [0] * len(TELEMETRY_CONFIG['buckets']), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(TELEMETRY_CONFIG['buckets']):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+class Span:
+    def __init__(self, name, labels, fields):
+        self.name = name
+        self.labels = labels
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        observe(self.name, seconds, self.labels)
+        write_event({
+            'ts': time.time(), 'type': 'span', 'name': self.name, 'duration_ms': seconds * 1000,
+            **self.labels, **self.fields, 'error': exc_type.__name__ if exc_type else None
+        })
+        return False
+
+def span(name, labels=None, **fields):
+    '''
+    Times the enclosed block (sync or async code). labels become metric labels, fields only appear in the trace file.
+    Disabled telemetry returns a shared no-op context, so instrumented hot paths pay a single branch.
+    '''
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, labels or {}, fields)
+
+def record(name, value=1, labels=None, **fields):
+    if not enabled:
+        return
+    labels = labels or {}
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+    write_event({'ts': time.time(), 'type': 'value', 'name': name, 'value': value, **labels, **fields})
+
+def format_labels(labels, extra=None):
+    items = list(labels) + (extra or [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in items) + '}'
+
+def render_metrics():
+    lines = []
+    with lock:
+        if histograms:
+            lines.append('# TYPE lina_span_seconds histogram')
+        for (name, labels), histogram in sorted(histograms.items()):
+            labels = [('span', name)] + list(labels)
+            for bound, count in zip(TELEMETRY_CONFIG['buckets'], histogram['buckets']):
+                lines.append(f"lina_span_seconds_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"lina_span_seconds_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"lina_span_seconds_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"lina_span_seconds_count{format_labels(labels)} {histogram['count']}")
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"lina_{name}_total{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    with lock:
+        return {
+            'spans': {
+                f"{name}{format_labels(labels)}": {'count': h['count'], 'total_s': h['sum']}
+                for (name, labels), h in histograms.items()
+            },
+            'counters': {f"{name}{format_labels(labels)}": value for (name, labels), value in counters.items()}
+        }
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', int(port)), MetricsHandler)
+    except OSError as e:
+        print(f"Could not start metrics endpoint on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
+metrics_server = start_metrics_server(TELEMETRY_CONFIG['metrics_port']) if TELEMETRY_CONFIG['metrics_port'] else None
@@ -0,0 +1,10 @@
+from functools import lru_cache
+
+import tiktoken
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
@@ -1,28 +1,71 @@
 import re
-import os
-from dotenv import load_dotenv
+import time
+import random
+import threading
+from functools import lru_cache
 
-from langchain.chains.summarize import load_summarize_chain
-from langchain_openai import AzureChatOpenAI
 from langchain.docstore.document import Document
-from langchain_community.document_loaders import UnstructuredWordDocumentLoader, PyPDFLoader, TextLoader
 
-from tqdm import tqdm
+from config import OPENAI_API_KEY, OPENAI_API_ENDPOINT, OPENAI_API_VERSION
+from chunk_store import write_chunks, read_chunks, iter_chunks, ChunkBackup, migrate_legacy_backup
+
+from tokens import count_tokens
 
-load_dotenv()
 deployment_name = 'gpt-4.1-nano'
-OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
-OPENAI_API_ENDPOINT = os.environ.get('OPENAI_API_ENDPOINT')
-OPENAI_API_VERSION = os.environ.get('OPENAI_API_VERSION')
-
-llm = AzureChatOpenAI(
-    deployment_name=deployment_name,
-    api_key=OPENAI_API_KEY,
-    azure_endpoint=OPENAI_API_ENDPOINT,
-    api_version=OPENAI_API_VERSION,
-    temperature=0,
-)
-summarizer = load_summarize_chain(llm, chain_type="stuff")
+
+@lru_cache(maxsize=None)
+def get_summarizer():
+    # Built on first use: commands that never summarize do not pay for the chain
+    from langchain.chains.summarize import load_summarize_chain
+    from langchain_openai import AzureChatOpenAI
+
+    llm = AzureChatOpenAI(
+        deployment_name=deployment_name,
+        api_key=OPENAI_API_KEY,
+        azure_endpoint=OPENAI_API_ENDPOINT,
+        api_version=OPENAI_API_VERSION,
+        temperature=0,
+        max_retries=0,
+        timeout=SUMMARIZER_CONFIG['request_timeout'],
+    )
+    return load_summarize_chain(llm, chain_type="stuff")
+
+SUMMARIZER_CONFIG = {
+    'max_workers' : 8,
+    'tokens_per_minute' : 200000,
+    'prompt_overhead_tokens' : 300,
+    'max_retries' : 6,
+    'backoff_base' : 1.0,
+    'backoff_max' : 60.0,
+    # Seconds before a summary request is abandoned (the hybrid summarizer then falls back to extractive)
+    'request_timeout' : 120
+}
+
+class TokenRateLimiter:
+    '''
+    Token bucket shared by every summarizer worker so the whole build stays under the deployment's tokens-per-minute quota.
+    '''
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+summary_rate_limiter = TokenRateLimiter(SUMMARIZER_CONFIG['tokens_per_minute'])
 
 def clean_text(text):
     text = text.replace('\n', ' ').replace('\t', ' ')
@@ -30,12 +73,6 @@ def clean_text(text):
     text = re.sub(r'[^\x00-\x7F]+', ' ', text)
     return text.strip()
 
-def clean_data(data):
-    data = [doc for doc in data if len(doc.page_content.strip()) > 20]
-    for doc in data:
-        doc.page_content = clean_text(doc.page_content)
-    return data
-
 def add_chunk_index(chunks):
     for i,chunk in enumerate(chunks):
         chunk.metadata['chunk_index'] = int(i)
@@ -47,68 +84,41 @@ def retype_metadata(chunks):
             if isinstance(value, list):
                 doc.metadata[key] = str(value)
 
-def write_chunks(chunks, output_path):
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, "w", encoding="utf-8") as f:
-        for doc in chunks:
-            f.write(f"{repr(doc)}\n")
-
-def read_chunks(input_path):
-    chunks = []
-    with open(input_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                chunks.append(eval(line))
-    return chunks
-
-def load_documents(file_path):
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File path does not exist: {file_path}")
-
-    ext = os.path.splitext(file_path)[1].lower()
-
-    if ext == ".pdf":
-        loader = PyPDFLoader(file_path)
-    elif ext == ".txt":
-        loader = TextLoader(file_path)
-    elif ext in [".doc", ".docx"]:
-        loader = UnstructuredWordDocumentLoader(file_path)
-    else:
-        raise ValueError(f"Unsupported file type: {ext}. Only .pdf, .txt, and .doc/.docx are supported.")
-
-    data = loader.load()
-    print(f"Data loaded succesfully with total {len(data)} pages!")
-    return data
-    
-def up_level_chunking(chunks, n_content_chunks, level, log_error=False):
-    high_level_chunks = []
-    index = 0
-
-    for i in tqdm(range(0, len(chunks), n_content_chunks), desc=f"Level {level} Chunking"):
+def is_rate_limit_error(e):
+    if getattr(e, 'status_code', None) == 429:
+        return True
+    msg = str(e).lower()
+    return "429" in msg or "rate limit" in msg
+
+def retry_after_seconds(e):
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def summarize_group(group, rate_limiter=None):
+    if rate_limiter is not None:
+        tokens = sum(count_tokens(doc.page_content) for doc in group)
+        rate_limiter.acquire(tokens + SUMMARIZER_CONFIG['prompt_overhead_tokens'])
+
+    max_retries = SUMMARIZER_CONFIG['max_retries']
+    for attempt in range(max_retries + 1):
         try:
-            group = chunks[i : i + n_content_chunks]
-            summary = summarizer.invoke(group)
-            doc = Document(
-                page_content=summary['output_text'],
-                metadata={
-                    "level": level,
-                    "group_index": list(range(i, i + n_content_chunks)),
-                    "chunk_index": index
-                }
-            )
-            high_level_chunks.append(doc)
-            index += 1
+            return get_summarizer().invoke(group)['output_text']
         except Exception as e:
-            if log_error:
-                msg = str(e).lower()
-                if "content management policy" in msg or "response was filtered" in msg or "content filter" in msg:
-                    print(f"[!] Warning at group {i // n_content_chunks} : {e}")
-                else:
-                    print(f"[!] Error at group {i // n_content_chunks}: {e}")
-            continue
-
-    return high_level_chunks
-
-
-
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = min(SUMMARIZER_CONFIG['backoff_max'], SUMMARIZER_CONFIG['backoff_base'] * 2 ** attempt)
+                delay = delay * (0.5 + random.random() / 2)
+            time.sleep(delay)
+
+def log_summary_error(group_number, e):
+    msg = str(e).lower()
+    if "content management policy" in msg or "response was filtered" in msg or "content filter" in msg:
+        print(f"[!] Warning at group {group_number} : {e}")
+    else:
+        print(f"[!] Error at group {group_number}: {e}")
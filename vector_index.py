@@ -0,0 +1,284 @@
+import os
+
+import numpy as np
+
+from langchain.docstore.document import Document
+
+QUANTIZATION_CONFIG = {
+    # Leading dimensions kept for the coarse pass (text-embedding-3 vectors are Matryoshka-trained), None keeps all
+    'truncate_dims' : 512,
+    # 'int8' (one byte per dimension) or 'binary' (one bit per dimension, Hamming distance)
+    'quantization' : 'int8',
+    # The coarse pass keeps k * rescore_factor candidates, which are then re-scored with the full vectors
+    'rescore_factor' : 4,
+    'load_batch_size' : 2000
+}
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def normalize_rows(matrix):
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class NumpyVectorStore:
+    '''
+    In-memory replacement for one Chroma level: rows are pre-normalized so top-k is a single matmul plus argpartition,
+    and the chunk_index / book_id filters become a row subset instead of a metadata scan.
+    Scores follow Chroma's default l2 space (squared distance, lower is better) so both backends are interchangeable.
+    '''
+    def __init__(self, documents, vectors, embedding):
+        self.documents = documents
+        self.embedding = embedding
+        # An empty level (skipped by the build, or a library with no book yet) holds no vectors to take a width from
+        self.matrix = normalize_rows(np.asarray(vectors, dtype=np.float32)) if documents else np.zeros((0, 0), dtype=np.float32)
+        self.index_rows()
+
+    @classmethod
+    def from_chroma(cls, store, embedding):
+        data = store.get(include=['embeddings', 'documents', 'metadatas'])
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data['documents'], data['metadatas'])
+        ]
+        return cls(documents, data['embeddings'], embedding)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def index_rows(self):
+        # Rows keyed by (book_id, chunk_index), book_id is None outside library mode
+        self.row_by_chunk_index = {}
+        rows_by_book = {}
+        for row, doc in enumerate(self.documents):
+            book_id = doc.metadata.get('book_id')
+            rows_by_book.setdefault(book_id, []).append(row)
+            if 'chunk_index' in doc.metadata:
+                self.row_by_chunk_index[(book_id, int(doc.metadata['chunk_index']))] = row
+        self.rows_by_book = {book_id: np.asarray(rows, dtype=np.int64) for book_id, rows in rows_by_book.items()}
+
+    def _rows(self, filter):
+        if not filter:
+            return None
+        rows = self._filter_rows(filter)
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def _filter_rows(self, filter):
+        # The filters built by hierarchical_retriever.chunk_filter: chunk_index "$in", book_id "$in",
+        # their "$and" for one book, and an "$or" of those across books
+        if list(filter) == ['$or']:
+            return [rows for clause in filter['$or'] for rows in self._filter_rows(clause)]
+        conditions = {}
+        for clause in (filter['$and'] if list(filter) == ['$and'] else [filter]):
+            conditions.update(clause)
+        if not set(conditions) <= {'book_id', 'chunk_index'} or 'chunk_index' in conditions and list(conditions['chunk_index']) != ['$in']:
+            raise ValueError(f"Unsupported filter for NumpyVectorStore: {filter}")
+
+        books = conditions.get('book_id')
+        books = books['$in'] if isinstance(books, dict) else [books]
+        if 'chunk_index' not in conditions:
+            return [self.rows_by_book[book_id] for book_id in books if book_id in self.rows_by_book]
+        rows = [
+            self.row_by_chunk_index[(book_id, int(i))] for book_id in books for i in conditions['chunk_index']['$in']
+            if (book_id, int(i)) in self.row_by_chunk_index
+        ]
+        return [np.asarray(rows, dtype=np.int64)]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, **kwargs):
+        if not self.documents:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        rows = self._rows(filter)
+        if rows is None:
+            scores = self.matrix @ query
+            rows = np.arange(len(self.documents))
+        elif len(rows) == 0:
+            return []
+        else:
+            scores = self.matrix[rows] @ query
+
+        return [(self.documents[rows[i]], float(2.0 - 2.0 * scores[i])) for i in top_k(scores, k)]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=filter)]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k=k, filter=filter)
+
+    async def asimilarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(embedding, k=k, filter=filter)
+
+    async def asimilarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(await self.embedding.aembed_query(query), k=k, filter=filter)
+
+
+class QuantizedVectorStore(NumpyVectorStore):
+    '''
+    NumpyVectorStore whose RAM holds only compressed vectors: the first truncate_dims dimensions, re-normalized and
+    quantized to int8 (per-row scale) or to sign bits. A coarse pass over the codes picks k * rescore_factor candidates,
+    which are re-scored exactly against the full float32 vectors kept in a memory-mapped file, so only their pages are read.
+    '''
+    def __init__(self, documents, vectors, embedding, full_vectors_path=None, truncate_dims=None, quantization='int8', rescore_factor=4, **kwargs):
+        self.documents = documents
+        self.embedding = embedding
+        self.truncate_dims = truncate_dims
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        if quantization not in ('int8', 'binary'):
+            raise ValueError(f"Unknown quantization '{quantization}', expected 'int8' or 'binary'.")
+
+        if isinstance(vectors, np.memmap):
+            self.matrix = vectors
+        elif not documents:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        else:
+            self.matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+            if full_vectors_path is not None:
+                self.matrix = save_memmap(full_vectors_path, self.matrix)
+        self.codes, self.scales = self.quantize(self.matrix)
+        self.index_rows()
+
+    @classmethod
+    def from_chroma(cls, store, embedding, full_vectors_path=None, load_batch_size=None, **kwargs):
+        '''
+        full_vectors_path is written by embedding.py at index time (export_full_vectors) and only memory-mapped here.
+        A missing or outdated file, from an index built before it existed, is exported once. Without a path the full
+        vectors are read from the store into RAM.
+        '''
+        load_batch_size = load_batch_size or QUANTIZATION_CONFIG['load_batch_size']
+        documents_by_id = {}
+        total = len(store.get(include=[])['ids'])
+        for offset in range(0, total, load_batch_size):
+            data = store.get(include=['documents', 'metadatas'], limit=load_batch_size, offset=offset)
+            for chunk_id, text, metadata in zip(data['ids'], data['documents'], data['metadatas']):
+                documents_by_id[chunk_id] = Document(page_content=text, metadata=metadata or {})
+
+        ids, matrix = load_full_vectors(full_vectors_path)
+        if matrix is None or len(ids) != len(documents_by_id) or any(chunk_id not in documents_by_id for chunk_id in ids):
+            if full_vectors_path is not None:
+                print(f"Exporting full vectors to {full_vectors_path}, embedding.py keeps them up to date from now on")
+            ids, matrix = export_full_vectors(store, full_vectors_path, load_batch_size)
+        # Documents follow the file's row order, the vectors are never copied
+        documents = [documents_by_id[chunk_id] for chunk_id in ids]
+        return cls(documents, matrix, embedding, **kwargs)
+
+    def coarse(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.truncate_dims:
+            vectors = vectors[..., :self.truncate_dims]
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def quantize(self, matrix):
+        if len(matrix) == 0:
+            return np.zeros((0, 0), dtype=np.uint8 if self.quantization == 'binary' else np.int8), np.zeros(0, dtype=np.float32)
+        codes, scales = [], []
+        batch_size = QUANTIZATION_CONFIG['load_batch_size']
+        for start in range(0, len(matrix), batch_size):
+            block = self.coarse(matrix[start : start + batch_size])
+            if self.quantization == 'binary':
+                codes.append(np.packbits(block > 0, axis=1))
+            else:
+                scale = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127.0
+                codes.append(np.round(block / scale[:, None]).astype(np.int8))
+                scales.append(scale.astype(np.float32))
+        return np.concatenate(codes), (np.concatenate(scales) if scales else None)
+
+    def memory_bytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def coarse_scores(self, query, rows):
+        codes = self.codes if rows is None else self.codes[rows]
+        if self.quantization == 'binary':
+            query_bits = np.packbits(self.coarse(query) > 0)
+            # Fewer differing sign bits is better, negate so that higher scores win like the float path
+            return -POPCOUNT[np.bitwise_xor(codes, query_bits)].sum(axis=1, dtype=np.int32)
+        scales = self.scales if rows is None else self.scales[rows]
+        query = self.coarse(query)
+        scores = np.empty(len(codes), dtype=np.float32)
+        batch_size = QUANTIZATION_CONFIG['load_batch_size']
+        for start in range(0, len(codes), batch_size):
+            scores[start : start + batch_size] = codes[start : start + batch_size].astype(np.float32) @ query
+        return scores * scales
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, **kwargs):
+        if not self.documents:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        rows = self._rows(filter)
+        if rows is None:
+            candidates = top_k(self.coarse_scores(query, None), k * self.rescore_factor)
+        elif len(rows) == 0:
+            return []
+        else:
+            candidates = rows[top_k(self.coarse_scores(query, rows), k * self.rescore_factor)]
+        if len(candidates) == 0:
+            return []
+        # Sorted rows read the memory-mapped file front to back
+        candidates = np.sort(candidates)
+        exact = np.asarray(self.matrix[candidates]) @ query
+        return [(self.documents[candidates[i]], float(2.0 - 2.0 * exact[i])) for i in top_k(exact, k)]
+
+def full_vectors_path(persist_directory, level):
+    return f"{persist_directory}/full_vectors/level_{level}.npy"
+
+def full_vectors_ids_path(path):
+    return os.path.splitext(path)[0] + '.ids.npy'
+
+def load_full_vectors(path):
+    # (ids, memory-mapped vectors) written by export_full_vectors, (None, None) when there is no file
+    if path is None or not os.path.exists(path) or not os.path.exists(full_vectors_ids_path(path)):
+        return None, None
+    return np.load(full_vectors_ids_path(path)).tolist(), np.load(path, mmap_mode='r')
+
+def export_full_vectors(store, path, load_batch_size=None):
+    '''
+    Normalized float32 vectors of one level and their ids, paged out of the store so they never sit in RAM all at once.
+    Returns (ids, vectors), memory-mapped from path when one is given.
+    '''
+    load_batch_size = load_batch_size or QUANTIZATION_CONFIG['load_batch_size']
+    total = len(store.get(include=[])['ids'])
+    tmp_path = None if path is None else path + '.tmp.npy'
+    ids = []
+    matrix = None
+    for offset in range(0, total, load_batch_size):
+        data = store.get(include=['embeddings'], limit=load_batch_size, offset=offset)
+        batch = normalize_rows(np.asarray(data['embeddings'], dtype=np.float32))
+        if matrix is None:
+            matrix = open_memmap(tmp_path, (total, batch.shape[1]))
+        matrix[offset : offset + len(batch)] = batch
+        ids.extend(data['ids'])
+    if matrix is None:
+        matrix = open_memmap(tmp_path, (0, 0))
+    if path is None:
+        return ids, matrix
+    matrix.flush()
+    del matrix
+    np.save(full_vectors_ids_path(path) + '.tmp.npy', np.asarray(ids, dtype=str))
+    os.replace(tmp_path, path)
+    os.replace(full_vectors_ids_path(path) + '.tmp.npy', full_vectors_ids_path(path))
+    return load_full_vectors(path)
+
+def open_memmap(path, shape):
+    if path is None:
+        return np.zeros(shape, dtype=np.float32)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+def save_memmap(path, matrix):
+    memmap = open_memmap(path, matrix.shape)
+    memmap[:] = matrix
+    memmap.flush()
+    return np.load(path, mmap_mode='r')